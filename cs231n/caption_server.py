@@ -0,0 +1,228 @@
+from __future__ import print_function, division
+import asyncio
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+"""
+This file implements an asynchronous front end for serving captions from a
+CaptioningRNN. Single-image requests are queued and grouped into micro-batches,
+so that each call to model.sample runs on a full minibatch and makes good use
+of BLAS. This module needs Python 3.
+"""
+
+
+class CaptionServer(object):
+    """
+    A CaptionServer accepts one image feature vector per request and resolves
+    each request with its sampled caption.
+
+    Requests are collected into a micro-batch until either max_batch_size
+    requests are waiting or the oldest one has waited max_latency seconds. The
+    batch is then captioned by model.sample in a worker thread, so the event
+    loop keeps accepting requests while the model runs.
+
+    Example usage:
+
+    server = CaptionServer(model, max_batch_size=64, max_latency=0.005)
+    await server.start()
+    caption = await server.caption(features)  # features of shape (D,)
+    await server.stop()
+    print(server.stats())
+    """
+
+    def __init__(self, model, max_batch_size=64, max_latency=0.005,
+                 max_length=30, history=10000):
+        """
+        Construct a new CaptionServer.
+
+        Inputs:
+        - model: A CaptioningRNN, or any object with a compatible sample method
+        - max_batch_size: Largest number of requests passed to one sample call
+        - max_latency: Longest time in seconds that a request waits for more
+          requests to join its batch
+        - max_length: Maximum caption length passed to model.sample
+        - history: Number of recent request latencies kept for the statistics
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.max_length = max_length
+
+        self._queue = None
+        self._batcher = None
+        self._batch = []
+        self._executor = None
+        self._latencies = collections.deque(maxlen=history)
+        self._batch_sizes = collections.deque(maxlen=history)
+        self._num_requests = 0
+        self._start_time = None
+
+
+    async def start(self):
+        """
+        Start the batching task on the running event loop.
+        """
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._start_time = time.perf_counter()
+        self._batcher = asyncio.ensure_future(self._run())
+
+
+    async def stop(self):
+        """
+        Stop the batching task. Requests that are still queued, or in the batch
+        that was being collected or captioned, are cancelled.
+        """
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        for _, future, _ in self._batch:
+            future.cancel()
+        self._batch = []
+        while not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            future.cancel()
+        # Wait for a running model.sample call to finish without blocking the
+        # event loop.
+        await asyncio.get_event_loop().run_in_executor(None, self._executor.shutdown)
+
+
+    async def caption(self, features):
+        """
+        Caption a single image.
+
+        Inputs:
+        - features: Image features of shape (D,)
+
+        Returns:
+        - caption: Integer array of shape (max_length,), as for one row of the
+          output of model.sample
+        """
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((features, future, time.perf_counter()))
+        return await future
+
+
+    async def _next_batch(self):
+        """
+        Wait for the next request, then collect more until the batch is full or
+        the first request's deadline has passed. The batch is built in
+        self._batch, so that stop() can cancel its requests.
+        """
+        batch = self._batch = []
+        batch.append(await self._queue.get())
+        deadline = batch[0][2] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._next_batch()
+            features = np.stack([f for f, _, _ in batch])
+            try:
+                captions = await loop.run_in_executor(
+                    self._executor, self.model.sample, features, self.max_length)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                self._batch = []
+                continue
+
+            now = time.perf_counter()
+            for (_, future, start), caption in zip(batch, captions):
+                if not future.done():
+                    future.set_result(caption)
+                self._latencies.append(now - start)
+            self._num_requests += len(batch)
+            self._batch_sizes.append(len(batch))
+            self._batch = []
+
+
+    def stats(self):
+        """
+        Return a dictionary of serving statistics: the number of requests and
+        batches served, the mean batch size, the throughput in requests per
+        second since start(), and the p50 and p99 latency in seconds over the
+        most recent requests.
+        """
+        elapsed = time.perf_counter() - self._start_time if self._start_time else 0.0
+        latencies = np.asarray(self._latencies)
+        stats = {
+            'requests': self._num_requests,
+            'batches': len(self._batch_sizes),
+            'mean_batch_size': np.mean(self._batch_sizes) if self._batch_sizes else 0.0,
+            'throughput': self._num_requests / elapsed if elapsed > 0 else 0.0,
+            'p50_latency': 0.0,
+            'p99_latency': 0.0,
+        }
+        if len(latencies) > 0:
+            stats['p50_latency'] = np.percentile(latencies, 50)
+            stats['p99_latency'] = np.percentile(latencies, 99)
+        return stats
+
+
+async def benchmark(server, feature_dim, num_clients=64, requests_per_client=20):
+    """
+    Drive a server with synthetic concurrent clients. Each client sends its
+    requests one after the other with random feature vectors.
+
+    Returns the server statistics after all requests have completed.
+    """
+    async def client():
+        for _ in range(requests_per_client):
+            await server.caption(np.random.randn(feature_dim))
+
+    await server.start()
+    try:
+        await asyncio.gather(*[client() for _ in range(num_clients)])
+    finally:
+        await server.stop()
+    return server.stats()
+
+
+if __name__ == '__main__':
+    import argparse
+    from cs231n.classifiers.rnn import CaptioningRNN
+
+    parser = argparse.ArgumentParser(description='Benchmark the caption server.')
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--max_batch_size', type=int, default=64)
+    parser.add_argument('--max_latency', type=float, default=0.005)
+    parser.add_argument('--vocab_size', type=int, default=1000)
+    parser.add_argument('--input_dim', type=int, default=512)
+    parser.add_argument('--hidden_dim', type=int, default=512)
+    parser.add_argument('--cell_type', default='lstm')
+    args = parser.parse_args()
+
+    word_to_idx = {'<NULL>': 0, '<START>': 1, '<END>': 2}
+    for i in range(3, args.vocab_size):
+        word_to_idx['word%d' % i] = i
+    model = CaptioningRNN(word_to_idx, input_dim=args.input_dim,
+                          hidden_dim=args.hidden_dim, cell_type=args.cell_type)
+    server = CaptionServer(model, max_batch_size=args.max_batch_size,
+                           max_latency=args.max_latency)
+
+    stats = asyncio.run(
+        benchmark(server, args.input_dim, args.clients, args.requests))
+    for k in sorted(stats):
+        print('%s: %s' % (k, stats[k]))
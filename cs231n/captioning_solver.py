@@ -1,10 +1,29 @@
 from __future__ import print_function, division
 from builtins import range
 from builtins import object
+import multiprocessing
+import time
+import traceback
 import numpy as np
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from cs231n import optim
-from cs231n.coco_utils import sample_coco_minibatch
+from cs231n.checkpoint import CheckpointWriter, load_arrays
+from cs231n.data_loader import MinibatchLoader
+from cs231n.coco_utils import decode_captions
+from cs231n.sparse import RowSparseGrad, sum_rows_by_index
+
+try:
+    from nltk.translate.bleu_score import sentence_bleu
+except ImportError:
+    sentence_bleu = None
+
+
+_SPECIAL_WORDS = ('<START>', '<END>', '<NULL>', '<UNK>')
 
 
 class CaptioningSolver(object):
@@ -27,7 +46,11 @@ class CaptioningSolver(object):
     In addition, the instance variable solver.loss_history will contain a list
     of all losses encountered during training and the instance variables
     solver.train_acc_history and solver.val_acc_history will be lists containing
-    the accuracies of the model on the training and validation set at each epoch.
+    the accuracies of the model on the training and validation set at each epoch;
+    with validate=True each entry of val_acc_history is the dictionary of
+    metrics returned by check_accuracy.
+    solver.data_time and solver.step_time hold the total number of seconds spent
+    waiting for training minibatches and in training steps.
 
     Example usage might look something like this:
 
@@ -62,6 +85,9 @@ class CaptioningSolver(object):
       - loss: Scalar giving the loss
       - grads: Dictionary with the same keys as self.params mapping parameter
         names to gradients of the loss with respect to those parameters.
+
+      check_accuracy calls model.loss(features, captions, mode='test',
+      backward=False), which only has to compute the loss; grads may be empty.
     """
 
     def __init__(self, model, data, **kwargs):
@@ -88,6 +114,38 @@ class CaptioningSolver(object):
           iterations.
         - verbose: Boolean; if set to false then no output will be printed during
           training.
+        - loader: An object with a next_batch() method returning training
+          minibatches (captions, features, urls), such as a PrefetchingLoader
+          from data_loader.py. Default is a MinibatchLoader, which samples each
+          minibatch when it is needed.
+        - micro_batch_size: If given, each minibatch is split into chunks of at
+          most this many captions whose gradients are accumulated before a
+          single parameter update. This bounds the memory used by model.loss,
+          so that batch_size can be much larger.
+        - checkpoint_name: If not None, save a checkpoint of the model and
+          optimizer state to the file checkpoint_name + '.npz' at the end of
+          every epoch. Each checkpoint replaces the previous one and is written
+          in a background thread.
+        - checkpoint_every: If given, save a checkpoint every checkpoint_every
+          iterations instead of every epoch.
+        - validate: If True, evaluate the model on the validation split with
+          check_accuracy at the end of every epoch.
+        - num_val_samples, val_batch_size, bleu_samples: Passed on to
+          check_accuracy as num_samples, batch_size and bleu_samples.
+        - background_validation: If True, each validation runs in a forked
+          process on a snapshot of the parameters, while training continues.
+          If it raises or its process dies, train raises a RuntimeError.
+        - flat_update: If True, the parameters, gradients and optimizer state
+          are kept in single flat arrays (the parameters in model.params become
+          views into one of them) and the update rule runs once per step over
+          all parameters rather than once per parameter. All parameters share
+          one learning rate, and row-sparse gradients are applied densely.
+          This does not work with models whose params dictionary copies on
+          assignment, such as a ParallelModel.
+        - profiler: A Profiler from profiling.py. If given, every iteration is
+          split into the stages data, the stages of model.loss (if the model
+          has a timer attribute), loss (the rest of model.loss) and update, and
+          its record is written to the profiler's sinks.
         """
         self.model = model
         self.data = data
@@ -101,6 +159,21 @@ class CaptioningSolver(object):
 
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
+        self.loader = kwargs.pop('loader', None)
+        self.micro_batch_size = kwargs.pop('micro_batch_size', None)
+        self.checkpoint_name = kwargs.pop('checkpoint_name', None)
+        self.checkpoint_every = kwargs.pop('checkpoint_every', None)
+        self.validate = kwargs.pop('validate', False)
+        self.num_val_samples = kwargs.pop('num_val_samples', None)
+        self.val_batch_size = kwargs.pop('val_batch_size', 100)
+        self.bleu_samples = kwargs.pop('bleu_samples', 0)
+        self.background_validation = kwargs.pop('background_validation', False)
+        self.flat_update = kwargs.pop('flat_update', False)
+        self.profiler = kwargs.pop('profiler', None)
+        if self.profiler is not None and hasattr(model, 'timer'):
+            model.timer = self.profiler
+        if self.loader is None:
+            self.loader = MinibatchLoader(data, batch_size=self.batch_size)
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
@@ -123,11 +196,18 @@ class CaptioningSolver(object):
         """
         # Set up some variables for book-keeping
         self.epoch = 0
+        self.iteration = 0
         self.best_val_acc = 0
         self.best_params = {}
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
+        self.data_time = 0.0
+        self.step_time = 0.0
+        self._grad_accum = None
+        self._checkpoint_writer = CheckpointWriter()
+        self._validation = None
+        self._flat = None
 
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
@@ -141,66 +221,354 @@ class CaptioningSolver(object):
         Make a single gradient update. This is called by train() and should not
         be called manually.
         """
-        # Make a minibatch of training data
-        minibatch = sample_coco_minibatch(self.data,
-                      batch_size=self.batch_size,
-                      split='train')
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start()
+
+        # Make a minibatch of training data, keeping track of the time spent
+        # waiting for it
+        start = time.time()
+        minibatch = self.loader.next_batch()
         captions, features, urls = minibatch
+        self.data_time += time.time() - start
+        if profiler is not None:
+            profiler.lap('data')
 
         # Compute loss and gradient
-        loss, grads = self.model.loss(features, captions)
+        loss, grads = self._loss(features, captions)
         self.loss_history.append(loss)
+        if profiler is not None:
+            profiler.lap('loss')
 
         # Perform a parameter update
-        for p, w in self.model.params.items():
+        if self.flat_update:
+            self._flat_step(grads)
+        else:
+            for p, w in self.model.params.items():
+                dw = grads[p]
+                config = self.optim_configs[p]
+                next_w, next_config = self.update_rule(w, dw, config)
+                self.model.params[p] = next_w
+                self.optim_configs[p] = next_config
+
+        if profiler is not None:
+            profiler.lap('update')
+            null = getattr(self.model, '_null', 0)
+            profiler.end(self.iteration + 1, captions.shape[0],
+                         np.count_nonzero(captions[:, 1:] != null))
+
+
+    def _loss(self, features, captions):
+        """
+        Compute the loss and gradients on a minibatch, in chunks of at most
+        micro_batch_size captions. The gradient of each chunk is weighted by its
+        share of the minibatch and summed into preallocated accumulators, so the
+        result is the same as for a single call to model.loss.
+        """
+        N = captions.shape[0]
+        B = self.micro_batch_size
+        if B is None or N <= B:
+            return self.model.loss(features, captions)
+
+        if self.flat_update:
+            self._grad_accum = self._setup_flat()['grads']
+        elif self._grad_accum is None:
+            self._grad_accum = {p: np.empty_like(w) for p, w in self.model.params.items()}
+        grads = dict(self._grad_accum)
+        sparse = {}
+
+        loss = 0.0
+        for start in range(0, N, B):
+            end = min(start + B, N)
+            weight = (end - start) / N
+            chunk_loss, chunk_grads = self.model.loss(features[start:end],
+                                                      captions[start:end])
+            loss += weight * chunk_loss
+            for p, dw in chunk_grads.items():
+                if isinstance(dw, RowSparseGrad):
+                    np.multiply(dw.rows, weight, out=dw.rows)
+                    sparse.setdefault(p, []).append(dw)
+                elif start == 0:
+                    np.multiply(dw, weight, out=grads[p])
+                else:
+                    np.multiply(dw, weight, out=dw)
+                    grads[p] += dw
+
+        # Row-sparse gradients stay sparse; their rows are summed at the end.
+        for p, parts in sparse.items():
+            idx, rows = sum_rows_by_index(np.concatenate([g.idx for g in parts]),
+                                          np.concatenate([g.rows for g in parts]))
+            grads[p] = RowSparseGrad(idx, rows, parts[0].shape)
+        return loss, grads
+
+
+    def _setup_flat(self):
+        """
+        Move the parameters, and any optimizer state arrays they already have,
+        into flat arrays for flat_update; this is done once, on first use.
+        """
+        if self._flat is not None:
+            return self._flat
+
+        params = self.model.params
+        flat_params, views = optim.flatten_params(params)
+        for p, view in views.items():
+            params[p] = view
+            if params[p] is not view:
+                raise ValueError('flat_update needs a plain params dictionary')
+        flat_grads, grad_views = optim.flatten_params(params)
+
+        # Gather optimizer state, e.g. from a checkpoint, into flat arrays too.
+        names = sorted(params)
+        config = dict(self.optim_configs[names[0]])
+        for k, v in config.items():
+            if isinstance(v, np.ndarray) and not k.startswith('_'):
+                config[k] = np.concatenate([self.optim_configs[p][k].ravel() for p in names])
+        config.pop('_scratch', None)
+
+        slices, offset = {}, 0
+        for p in names:
+            slices[p] = (offset, offset + params[p].size)
+            offset += params[p].size
+
+        self._flat = {'params': flat_params, 'grads': grad_views, 'flat_grads': flat_grads,
+                      'config': config, 'names': names, 'slices': slices}
+        return self._flat
+
+
+    def _flat_step(self, grads):
+        """
+        Copy the gradients into the flat gradient array, run the update rule
+        once on the flat parameters, and point the per-parameter optimizer
+        configs at views of the flat optimizer state.
+        """
+        flat = self._setup_flat()
+        for p, view in flat['grads'].items():
             dw = grads[p]
-            config = self.optim_configs[p]
-            next_w, next_config = self.update_rule(w, dw, config)
-            self.model.params[p] = next_w
-            self.optim_configs[p] = next_config
-
-
-    # TODO: This does nothing right now; maybe implement BLEU?
-    def check_accuracy(self, X, y, num_samples=None, batch_size=100):
+            if isinstance(dw, RowSparseGrad):
+                view[...] = 0
+                view[dw.idx] = dw.rows
+            elif dw is not view:
+                view[...] = dw
+
+        config = flat['config']
+        config['learning_rate'] = self.optim_configs[flat['names'][0]]['learning_rate']
+        next_w, config = self.update_rule(flat['params'], flat['flat_grads'], config)
+        if next_w is not flat['params']:
+            flat['params'][...] = next_w
+        flat['config'] = config
+
+        for p in flat['names']:
+            start, end = flat['slices'][p]
+            shape = self.model.params[p].shape
+            for k, v in config.items():
+                if k.startswith('_'):
+                    continue
+                if isinstance(v, np.ndarray) and v.shape == flat['params'].shape:
+                    v = v[start:end].reshape(shape)
+                self.optim_configs[p][k] = v
+
+
+    def check_accuracy(self, split='val', num_samples=None, batch_size=100,
+                       bleu_samples=0):
         """
-        Check accuracy of the model on the provided data.
+        Evaluate the model on a split of the data.
+
+        The masked loss of every caption is computed in minibatches that are
+        gathered into preallocated buffers, and averaged over the words that are
+        not <NULL>. Optionally, captions are sampled for a random subset of the
+        captions' images and scored with unigram BLEU against those captions.
 
         Inputs:
-        - X: Array of data, of shape (N, d_1, ..., d_k)
-        - y: Array of labels, of shape (N,)
-        - num_samples: If not None, subsample the data and only test the model
-          on num_samples datapoints.
-        - batch_size: Split X and y into batches of this size to avoid using too
-          much memory.
+        - split: Which split of the data to evaluate on
+        - num_samples: If not None, only evaluate the loss on a random subset of
+          num_samples captions.
+        - batch_size: Number of captions per call to model.loss
+        - bleu_samples: Number of captions to compute the BLEU score on; BLEU
+          needs nltk and is skipped if this is 0.
 
         Returns:
-        - acc: Scalar giving the fraction of instances that were correctly
-          classified by the model.
+        - metrics: Dictionary with the per-word 'loss' and its 'perplexity', and
+          the mean 'bleu' score if bleu_samples > 0.
         """
-        return 0.0
+        captions = self.data['%s_captions' % split]
+        image_idxs = self.data['%s_image_idxs' % split]
+        features = self.data['%s_features' % split]
+        null = self.data['word_to_idx']['<NULL>']
 
         # Maybe subsample the data
-        N = X.shape[0]
+        N = captions.shape[0]
+        idx = np.arange(N)
         if num_samples is not None and N > num_samples:
-            mask = np.random.choice(N, num_samples)
-            N = num_samples
-            X = X[mask]
-            y = y[mask]
-
-        # Compute predictions in batches
-        num_batches = N / batch_size
-        if N % batch_size != 0:
-            num_batches += 1
-        y_pred = []
-        for i in range(num_batches):
-            start = i * batch_size
-            end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
-            y_pred.append(np.argmax(scores, axis=1))
-        y_pred = np.hstack(y_pred)
-        acc = np.mean(y_pred == y)
-
-        return acc
+            idx = np.random.choice(N, num_samples, replace=False)
+
+        # Compute the loss in batches
+        caption_buf = np.empty((batch_size,) + captions.shape[1:], dtype=captions.dtype)
+        image_buf = np.empty(batch_size, dtype=image_idxs.dtype)
+        feature_buf = np.empty((batch_size,) + features.shape[1:], dtype=features.dtype)
+        total_loss, total_words = 0.0, 0
+        for start in range(0, len(idx), batch_size):
+            batch = idx[start:start + batch_size]
+            n = len(batch)
+            np.take(captions, batch, axis=0, out=caption_buf[:n])
+            np.take(image_idxs, batch, axis=0, out=image_buf[:n])
+            np.take(features, image_buf[:n], axis=0, out=feature_buf[:n])
+            loss, _ = self.model.loss(feature_buf[:n], caption_buf[:n], mode='test',
+                                      backward=False)
+            total_loss += loss * n
+            total_words += np.sum(caption_buf[:n, 1:] != null)
+
+        loss = total_loss / max(total_words, 1)
+        metrics = {'loss': loss, 'perplexity': np.exp(loss)}
+        if bleu_samples > 0:
+            metrics['bleu'] = self._bleu(split, bleu_samples, batch_size)
+        return metrics
+
+
+    def _bleu(self, split, num_samples, batch_size):
+        """
+        Mean unigram BLEU score of captions sampled for the images of
+        num_samples random captions of a split, against those captions.
+        """
+        if sentence_bleu is None:
+            raise ImportError('Computing BLEU scores needs nltk')
+
+        captions = self.data['%s_captions' % split]
+        N = captions.shape[0]
+        mask = np.random.choice(N, min(num_samples, N), replace=False)
+        gt_captions = captions[mask]
+        features = self.data['%s_features' % split][self.data['%s_image_idxs' % split][mask]]
+
+        idx_to_word = self.data['idx_to_word']
+        scores = []
+        for start in range(0, len(mask), batch_size):
+            end = start + batch_size
+            samples = self.model.sample(features[start:end])
+            for gt, sample in zip(decode_captions(gt_captions[start:end], idx_to_word),
+                                  decode_captions(samples, idx_to_word)):
+                reference = [w for w in gt.split(' ') if w not in _SPECIAL_WORDS]
+                hypothesis = [w for w in sample.split(' ') if w not in _SPECIAL_WORDS]
+                scores.append(sentence_bleu([reference], hypothesis, weights=[1]))
+        return np.mean(scores)
+
+
+    def _start_validation(self):
+        """
+        Evaluate the validation split in a forked process, which works on a
+        snapshot of the parameters as they are now. The result is picked up by
+        _finish_validation.
+        """
+        self._finish_validation(block=True)
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        process = context.Process(target=self._validate_into, args=(results,))
+        process.daemon = True
+        process.start()
+        self._validation = (self.epoch, process, results)
+
+
+    def _validate_into(self, results):
+        try:
+            metrics = self.check_accuracy('val', self.num_val_samples,
+                                          self.val_batch_size, self.bleu_samples)
+        except Exception:
+            results.put(('error', traceback.format_exc()))
+        else:
+            results.put(('ok', metrics))
+
+
+    def _finish_validation(self, block=False):
+        """
+        Record the result of a background validation, if there is one and it
+        has finished (or block is True). Raises a RuntimeError if the
+        validation raised or its process died without a result.
+        """
+        if self._validation is None:
+            return
+        epoch, process, results = self._validation
+        while True:
+            try:
+                status, value = results.get(block=block, timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+            if not process.is_alive():
+                # The result may still be in flight when the process exits.
+                try:
+                    status, value = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    self._validation = None
+                    raise RuntimeError('Background validation exited with code %s'
+                                       % process.exitcode)
+            if not block:
+                return
+        process.join()
+        self._validation = None
+        if status == 'error':
+            raise RuntimeError('Background validation failed:\n' + value)
+        self._record_validation(epoch, value)
+
+
+    def _record_validation(self, epoch, metrics):
+        self.val_acc_history.append(metrics)
+        if self.verbose:
+            print('(Epoch %d / %d) %s' % (epoch, self.num_epochs, ', '.join(
+                  'val %s: %f' % (k, metrics[k]) for k in sorted(metrics))))
+
+
+    def save_checkpoint(self, path, background=True):
+        """
+        Save the model parameters, the optimizer state of every parameter and
+        the training progress to path, as an uncompressed .npz file. The arrays
+        are copied first and, if background is True, written in a background
+        thread while training continues.
+        """
+        arrays = {
+          'epoch': self.epoch,
+          'iteration': self.iteration,
+          'loss_history': np.asarray(self.loss_history),
+          'train_acc_history': np.asarray(self.train_acc_history),
+        }
+        for k in (self.val_acc_history[0] if self.val_acc_history else {}):
+            arrays['val/%s' % k] = np.array([m[k] for m in self.val_acc_history])
+        for p, w in self.model.params.items():
+            arrays['params/%s' % p] = np.array(w)
+            for k, v in self.optim_configs[p].items():
+                if not k.startswith('_'):
+                    arrays['optim/%s/%s' % (p, k)] = np.array(v)
+        self._checkpoint_writer.save(path, arrays, background)
+        if self.verbose:
+            print('Saving checkpoint to "%s"' % path)
+
+
+    def load_checkpoint(self, path):
+        """
+        Restore the state saved by save_checkpoint, so that train() resumes
+        from the saved iteration. The file is memory-mapped and every array is
+        copied once into memory.
+        """
+        self._checkpoint_writer.wait()
+        self._flat = None
+        self._grad_accum = None
+        arrays = load_arrays(path, mmap=True)
+        self.epoch = int(arrays['epoch'])
+        self.iteration = int(arrays['iteration'])
+        self.loss_history = arrays['loss_history'].tolist()
+        self.train_acc_history = arrays['train_acc_history'].tolist()
+        val_keys = [k for k in arrays if k.startswith('val/')]
+        num_val = len(arrays[val_keys[0]]) if val_keys else 0
+        self.val_acc_history = [{k[len('val/'):]: arrays[k][i].item() for k in val_keys}
+                                for i in range(num_val)]
+
+        for p in self.model.params:
+            self.model.params[p] = np.array(arrays['params/%s' % p])
+            self.optim_configs[p] = {}
+        for key, value in arrays.items():
+            if key.startswith('optim/'):
+                _, p, k = key.split('/', 2)
+                value = np.array(value)
+                self.optim_configs[p][k] = value.item() if value.ndim == 0 else value
 
 
     def train(self):
@@ -208,11 +576,17 @@ class CaptioningSolver(object):
         Run optimization to train the model.
         """
         num_train = self.data['train_captions'].shape[0]
-        iterations_per_epoch = max(num_train // self.batch_size, 1)
+        iterations_per_epoch = getattr(self.loader, 'batches_per_epoch', None)
+        if iterations_per_epoch is None:
+            iterations_per_epoch = max(num_train // self.batch_size, 1)
         num_iterations = self.num_epochs * iterations_per_epoch
 
-        for t in range(num_iterations):
+        for t in range(self.iteration, num_iterations):
+            self._finish_validation()
+            start = time.time()
             self._step()
+            self.step_time += time.time() - start
+            self.iteration = t + 1
 
             # Maybe print training loss
             if self.verbose and t % self.print_every == 0:
@@ -227,9 +601,31 @@ class CaptioningSolver(object):
                 for k in self.optim_configs:
                     self.optim_configs[k]['learning_rate'] *= self.lr_decay
 
-            # Check train and val accuracy on the first iteration, the last
-            # iteration, and at the end of each epoch.
-            # TODO: Implement some logic to check Bleu on validation set periodically
+            if self.checkpoint_name is not None:
+                if self.checkpoint_every is None:
+                    save = epoch_end
+                else:
+                    save = (t + 1) % self.checkpoint_every == 0
+                if save:
+                    self.save_checkpoint(self.checkpoint_name + '.npz')
+
+            # Check the validation loss, perplexity and maybe BLEU at the end of
+            # each epoch.
+            if self.validate and epoch_end:
+                if self.background_validation:
+                    self._start_validation()
+                else:
+                    self._record_validation(self.epoch, self.check_accuracy(
+                        'val', self.num_val_samples, self.val_batch_size,
+                        self.bleu_samples))
+
+        self._finish_validation(block=True)
+        self._checkpoint_writer.wait()
+        if self.verbose:
+            print('Spent %.2fs of %.2fs waiting for data' % (
+                   self.data_time, self.step_time))
+            if self.profiler is not None:
+                print(self.profiler.summary())
 
         # At the end of training swap the best params into the model
         # self.model.params = self.best_params
@@ -0,0 +1,111 @@
+from __future__ import print_function, division
+from builtins import object
+import os
+import struct
+import threading
+import zipfile
+import numpy as np
+
+
+"""
+This file implements checkpoint files for the CaptioningSolver. A checkpoint
+is a single uncompressed .npz file. It is written to a temporary file that is
+then renamed over the old checkpoint, so a checkpoint on disk is always
+complete even if the process is killed while writing. Because the members of
+an uncompressed .npz file are stored as raw .npy files, they can be
+memory-mapped when the checkpoint is loaded instead of being read through
+the zip module.
+"""
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def save_arrays(path, arrays):
+    """
+    Atomically write a dictionary of arrays to path as an uncompressed .npz
+    file. Keys may contain '/'.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    _replace(tmp_path, path)
+
+
+def load_arrays(path, mmap=True):
+    """
+    Load a dictionary of arrays written by save_arrays.
+
+    With mmap=True the arrays are read-only memory maps of the file, found from
+    the offsets of the members of the zip archive, so nothing is read until it
+    is used. Scalars are always read into memory.
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as z, open(path, 'rb') as f:
+        for info in z.infolist():
+            key = info.filename[:-len('.npy')]
+            if not mmap or info.compress_type != zipfile.ZIP_STORED:
+                arrays[key] = np.lib.format.read_array(z.open(info))
+                continue
+
+            # Skip the local file header to the start of the .npy data.
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            start = info.header_offset + 30 + name_length + extra_length
+            f.seek(start)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            if len(shape) == 0 or dtype.hasobject or np.prod(shape) == 0:
+                f.seek(start)
+                arrays[key] = np.lib.format.read_array(f)
+            else:
+                arrays[key] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(),
+                                        shape=shape, order='F' if fortran_order else 'C')
+    return arrays
+
+
+class CheckpointWriter(object):
+    """
+    Write checkpoints with save_arrays in a background thread. At most one
+    write is in flight; save waits for the previous one to finish first.
+    The arrays passed to save must not be modified while they are written.
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._error = None
+
+
+    def save(self, path, arrays, background=True):
+        self.wait()
+        if not background:
+            save_arrays(path, arrays)
+            return
+        self._thread = threading.Thread(target=self._write, args=(path, arrays))
+        self._thread.start()
+
+
+    def _write(self, path, arrays):
+        try:
+            save_arrays(path, arrays)
+        except Exception as e:
+            self._error = e
+
+
+    def wait(self):
+        """
+        Wait for the current write to finish, raising any error it hit.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
@@ -1,9 +1,14 @@
 from builtins import range
 from builtins import object
+import collections
+import hashlib
 import numpy as np
 
 from cs231n.layers import *
 from cs231n.rnn_layers import *
+from cs231n.rnn_layers import _lstm_gate_forward
+from cs231n.quantization import QuantizedMatrix
+from cs231n.profiling import NULL_TIMER
 
 
 class CaptioningRNN(object):
@@ -19,7 +24,10 @@ class CaptioningRNN(object):
     """
 
     def __init__(self, word_to_idx, input_dim=512, wordvec_dim=128,
-                 hidden_dim=128, cell_type='rnn', dtype=np.float32):
+                 hidden_dim=128, cell_type='rnn', dtype=np.float32,
+                 check_dtype=False, bptt_steps=None, checkpoint_every=None,
+                 pack_sequences=False, output_block_size=None,
+                 sampled_softmax=None, sparse_embedding=False):
         """
         Construct a new CaptioningRNN instance.
 
@@ -32,12 +40,43 @@ class CaptioningRNN(object):
         - cell_type: What type of RNN to use; either 'rnn' or 'lstm'.
         - dtype: numpy datatype to use; use float32 for training and float64 for
           numeric gradient checking.
+        - check_dtype: If True, loss() asserts that every intermediate activation
+          and gradient keeps this dtype, to catch silent upcasts to float64.
+        - bptt_steps: If given, loss() uses truncated backpropagation through
+          time over chunks of this many timesteps, so that only one chunk of
+          activations is held in memory at a time.
+        - checkpoint_every: If given, the LSTM keeps only every k-th cell state
+          during loss() and recomputes the rest in the backward pass. The vanilla
+          RNN only caches its hidden states, so this has no effect there.
+        - pack_sequences: If True, loss() sorts the minibatch by caption length
+          and skips the recurrence, vocab projection and softmax for timesteps
+          past the last real word of each caption. Loss and gradients are the
+          same as without packing.
+        - output_block_size: If given, loss() computes the vocabulary scores,
+          softmax and their gradients for this many timesteps at a time, so the
+          full (N, T, V) score array is never materialised.
+        - sampled_softmax: If given, a dictionary with keys 'num_sampled' and
+          'noise' (a distribution over the vocabulary, for example from
+          unigram_distribution). Training-mode calls to loss() then use a
+          sampled softmax over num_sampled candidate words instead of the full
+          vocabulary; test-mode calls still use the exact softmax.
+        - sparse_embedding: If True, loss() returns the gradient of W_embed as
+          a RowSparseGrad over the words in the minibatch, and the update rules
+          only touch those rows.
         """
         if cell_type not in {'rnn', 'lstm'}:
             raise ValueError('Invalid cell_type "%s"' % cell_type)
 
         self.cell_type = cell_type
         self.dtype = dtype
+        self.check_dtype = check_dtype
+        self.bptt_steps = bptt_steps
+        self.checkpoint_every = checkpoint_every
+        self.pack_sequences = pack_sequences
+        self.output_block_size = output_block_size
+        self.sampled_softmax = sampled_softmax
+        self.sparse_embedding = sparse_embedding
+        self.timer = None
         self.word_to_idx = word_to_idx
         self.idx_to_word = {i: w for w, i in word_to_idx.items()}
         self.params = {}
@@ -75,7 +114,7 @@ class CaptioningRNN(object):
             self.params[k] = v.astype(self.dtype)
 
 
-    def loss(self, features, captions):
+    def loss(self, features, captions, mode='train', backward=True):
         """
         Compute training-time loss for the RNN. We input image features and
         ground-truth captions for those images, and use an RNN (or LSTM) to compute
@@ -85,10 +124,16 @@ class CaptioningRNN(object):
         - features: Input image features, of shape (N, D)
         - captions: Ground-truth captions; an integer array of shape (N, T) where
           each element is in the range 0 <= y[i, t] < V
+        - mode: 'train' or 'test'; in test mode the exact softmax loss is
+          computed even if the model trains with a sampled softmax.
+        - backward: If False, only run the forward pass and compute the exact
+          softmax loss, for example for validation. The vocabulary scores are
+          then computed in blocks of output_block_size (or 256) timesteps.
 
         Returns a tuple of:
         - loss: Scalar loss
-        - grads: Dictionary of gradients parallel to self.params
+        - grads: Dictionary of gradients parallel to self.params; empty if
+          backward is False
         """
         # Cut captions into two pieces: captions_in has everything but the last word
         # and will be input to the RNN; captions_out has everything but the first
@@ -138,38 +183,112 @@ class CaptioningRNN(object):
         # gradients for self.params[k].                                            #
         ############################################################################
 
-        ##forward pass
+        # If a timer such as a Profiler is attached, it records the time spent
+        # in each stage of the forward and backward pass.
+        timer = self.timer or NULL_TIMER
+
+        # Image features often come in as float64; cast them once so that the
+        # whole forward and backward pass runs in self.dtype.
+        features = features.astype(self.dtype, copy=False)
+
+        # To pack the sequences, sort the minibatch by the position of the last
+        # unmasked word and drop the trailing timesteps that are padding for every
+        # caption. The loss sums over the minibatch, so the order does not matter.
+        # At least one timestep is kept: if no caption has a target word, that
+        # step runs on no rows and the loss and gradients are zero.
+        lengths = None
+        if self.pack_sequences:
+            lengths = np.where(mask.any(axis=1),
+                               mask.shape[1] - np.argmax(mask[:, ::-1], axis=1), 0)
+            order = np.argsort(-lengths, kind='mergesort')
+            lengths = lengths[order]
+            features = features[order]
+            T_packed = max(lengths[0], 1)
+            captions_in = captions_in[order, :T_packed]
+            captions_out = captions_out[order, :T_packed]
+            mask = mask[order, :T_packed]
 
         #(1)
         h0 = np.dot( features, W_proj ) + b_proj
+        timer.lap('projection')
+
+        # With truncated backpropagation through time the sequence is processed
+        # in chunks of bptt_steps timesteps. The hidden (and cell) state is carried
+        # from one chunk to the next but no gradient flows back through it, so
+        # each chunk's caches are freed before the next chunk runs.
+        T = captions_in.shape[1]
+        chunk = self.bptt_steps or T
+        prev_h, prev_c = h0, None
+
+        for start in range(0, T, chunk):
+            end = min(start + chunk, T)
+            chunk_mask = mask[:, start:end]
+            chunk_lengths = None
+            if lengths is not None:
+                chunk_lengths = np.clip(lengths - start, 0, end - start)
+
+            ##forward pass
+
+            #(2)
+            x, word_cache = word_embedding_forward( captions_in[:, start:end], W_embed)
+            timer.lap('embedding')
+
+            #(3)
+            if self.cell_type == 'rnn':
+                hidden_state_vectors, rnn_cache = rnn_forward( x, prev_h, Wx, Wh, b, lengths=chunk_lengths)
+            if self.cell_type == 'lstm':
+                hidden_state_vectors, lstm_cache = lstm_forward(x, prev_h, Wx, Wh, b, c0=prev_c,
+                                                             checkpoint_every=self.checkpoint_every,
+                                                             lengths=chunk_lengths)
+                prev_c = lstm_final_cell( lstm_cache ).copy()
+            prev_h = hidden_state_vectors[:, -1].copy()
+            timer.lap('recurrence')
+
+            if not backward:
+                loss += temporal_affine_softmax_loss( hidden_state_vectors, W_vocab, b_vocab,
+                                                      captions_out[:, start:end], chunk_mask,
+                                                      block_size=self.output_block_size or 256,
+                                                      backward=False )
+                timer.lap('output')
+                continue
+
+            #(4), (5) and their backward pass
+            chunk_grads = {}
+            chunk_loss, dx_hiddenstatevectors, chunk_grads['W_vocab'], chunk_grads['b_vocab'] = \
+                self._output_loss( hidden_state_vectors, captions_out[:, start:end], chunk_mask, mode, timer )
+            loss += chunk_loss
+
+            ##backward pass
 
-        #(2)
-        x, word_cache = word_embedding_forward( captions_in, W_embed)
-
-        #(3)
-        if self.cell_type == 'rnn':
-            hidden_state_vectors, rnn_cache = rnn_forward( x, h0, Wx, Wh, b)
-        if self.cell_type == 'lstm':
-            hidden_state_vectors, lstm_cache = lstm_forward(x, h0, Wx, Wh, b)
-
-        #(4)
-        vocab, vocab_cache = temporal_affine_forward( hidden_state_vectors, W_vocab, b_vocab)
+            if self.cell_type == 'rnn':
+                dx, dprev_h, chunk_grads['Wx'], chunk_grads['Wh'], chunk_grads['b'] = rnn_backward( dx_hiddenstatevectors, rnn_cache)
+            if self.cell_type == 'lstm':
+                dx, dprev_h, chunk_grads['Wx'], chunk_grads['Wh'], chunk_grads['b'] = lstm_backward( dx_hiddenstatevectors, lstm_cache )
 
-        #(5)
-        loss, dout = temporal_softmax_loss( vocab, captions_out, mask )
+            chunk_grads['W_embed'] = word_embedding_backward( dx, word_cache, sparse=self.sparse_embedding)
+            timer.lap('backward')
 
-        ##backward pass
-        dx_hiddenstatevectors, grads['W_vocab'], grads['b_vocab'] = temporal_affine_backward( dout, vocab_cache )
+            # Only the first chunk reaches the image projection; later chunks are
+            # truncated at their initial hidden state.
+            if start == 0:
+                dh0 = dprev_h
 
-        if self.cell_type == 'rnn':
-            dx, dh0, grads['Wx'], grads['Wh'], grads['b'] = rnn_backward( dx_hiddenstatevectors, rnn_cache)
-        if self.cell_type == 'lstm':
-            dx, dh0, grads['Wx'], grads['Wh'], grads['b'] = lstm_backward( dx_hiddenstatevectors, lstm_cache )
+            for k, v in chunk_grads.items():
+                if k in grads:
+                    grads[k] += v
+                else:
+                    grads[k] = v
 
-        grads['W_embed'] = word_embedding_backward( dx, word_cache)
+        if not backward:
+            return loss, grads
 
         grads['b_proj'] = np.sum( dh0, axis=0 )
         grads['W_proj'] = np.dot( features.T, dh0 )
+        timer.lap('backward')
+
+        if self.check_dtype:
+            self._check_dtype(h0=h0, x=x, hidden_states=hidden_state_vectors,
+                              dhidden_states=dx_hiddenstatevectors, dh0=dh0, **grads)
 
         ############################################################################
         #                             END OF YOUR CODE                             #
@@ -178,7 +297,61 @@ class CaptioningRNN(object):
         return loss, grads
 
 
-    def sample(self, features, max_length=30):
+    def _output_loss(self, h, captions_out, mask, mode, timer=NULL_TIMER):
+        """
+        Vocabulary projection and softmax loss over a chunk of hidden states,
+        together with their backward pass.
+
+        Inputs:
+        - h: Hidden states, of shape (N, T, H)
+        - captions_out: Target words, of shape (N, T)
+        - mask: Boolean array of shape (N, T) of the targets that count
+        - mode: 'train' or 'test', as for loss()
+        - timer: Timer whose lap method is called after each stage; the fused
+          paths report a single 'output' stage.
+
+        Returns a tuple of:
+        - loss: Scalar loss
+        - dh: Gradient of the hidden states, of shape (N, T, H)
+        - dW_vocab, db_vocab: Gradients of the vocabulary projection
+        """
+        W_vocab, b_vocab = self.params['W_vocab'], self.params['b_vocab']
+
+        if self.sampled_softmax and mode == 'train':
+            out = temporal_sampled_softmax_loss( h, W_vocab, b_vocab, captions_out, mask,
+                                                 self.sampled_softmax['num_sampled'],
+                                                 self.sampled_softmax['noise'] )
+            timer.lap('output')
+            return out
+
+        if self.output_block_size:
+            out = temporal_affine_softmax_loss( h, W_vocab, b_vocab, captions_out, mask,
+                                                block_size=self.output_block_size )
+            timer.lap('output')
+            return out
+
+        # when packing, only score the timesteps that count towards the loss
+        vocab, vocab_cache = temporal_affine_forward( h, W_vocab, b_vocab,
+                                                      mask=mask if self.pack_sequences else None)
+        timer.lap('vocab_affine')
+        loss, dout = temporal_softmax_loss( vocab, captions_out, mask )
+        timer.lap('softmax')
+        dh, dW_vocab, db_vocab = temporal_affine_backward( dout, vocab_cache )
+        timer.lap('backward')
+        return loss, dh, dW_vocab, db_vocab
+
+
+    def _check_dtype(self, **arrays):
+        """
+        Assert that all of the named arrays have the model's dtype.
+        """
+        for name, a in sorted(arrays.items()):
+            assert a.dtype == self.dtype, '%s has dtype %s, expected %s' % (
+                name, a.dtype, np.dtype(self.dtype))
+
+
+    def sample(self, features, max_length=30, shortlist=None, shortlist_threshold=0.5,
+               state=None):
         """
         Run a test-time forward pass for the model, sampling captions for input
         feature vectors.
@@ -188,7 +361,8 @@ class CaptioningRNN(object):
         scores for all vocab words, and choose the word with the highest score as
         the next word. The initial hidden state is computed by applying an affine
         transform to the input image features, and the initial word is the <START>
-        token.
+        token. A caption is finished once it emits the <END> token; the rest of it
+        is filled with <NULL> and later steps only run on unfinished captions.
 
         For LSTMs you will also have to keep track of the cell state; in that case
         the initial cell state should be zero.
@@ -196,6 +370,14 @@ class CaptioningRNN(object):
         Inputs:
         - features: Array of input image features of shape (N, D).
         - max_length: Maximum length T of generated captions.
+        - shortlist: Optional integer array of shape (V, K), for example from
+          build_shortlist, giving the K candidate next words after each word.
+          If given, each step only scores the shortlist of the previous word.
+        - shortlist_threshold: With a shortlist, rows whose best candidate has a
+          probability below this value among the shortlisted words are scored
+          against the full vocabulary instead.
+        - state: Optional decoding state from encode_prefix; if given, the
+          captions continue the encoded prefix rather than starting afresh.
 
         Returns:
         - captions: Array of shape (N, max_length) giving sampled captions,
@@ -205,12 +387,6 @@ class CaptioningRNN(object):
         N = features.shape[0]
         captions = self._null * np.ones((N, max_length), dtype=np.int32)
 
-        # Unpack parameters
-        W_proj, b_proj = self.params['W_proj'], self.params['b_proj']
-        W_embed = self.params['W_embed']
-        Wx, Wh, b = self.params['Wx'], self.params['Wh'], self.params['b']
-        W_vocab, b_vocab = self.params['W_vocab'], self.params['b_vocab']
-
         ###########################################################################
         # TODO: Implement test-time sampling for the model. You will need to      #
         # initialize the hidden state of the RNN by applying the learned affine   #
@@ -233,30 +409,468 @@ class CaptioningRNN(object):
         # a loop.                                                                 #
         ###########################################################################
 
-        ##input those image features
-        cur_h = np.dot( features, W_proj ) + b_proj
-        cur_c = np.zeros_like( cur_h )
-        ##generate captions vector of start tokens
-        cur_capts = np.full( N, self._start)
+        ##input those image features, and generate captions vector of start tokens
+        cur_h, cur_c, cur_capts = self._start_state( features, state )
+        ##rows of captions that are still being generated
+        active = np.arange( N )
+        if shortlist is not None:
+            vocab_rows = self._vocab_rows()
 
         for t in range( 0, max_length ):
-            #(1) embed previous word
-            x, _ = word_embedding_forward(cur_capts, W_embed)
-            #(2) rnn step
-            if self.cell_type == 'rnn':
-                cur_h, _ = rnn_step_forward( x, cur_h, Wx, Wh, b )
-            #lstm step
-            if self.cell_type == 'lstm':
-                cur_h, cur_c, _ = lstm_step_forward(x, cur_h, cur_c, Wx, Wh, b)
-            #(3) learned affine transformation
-            vocab = np.dot( cur_h, W_vocab ) + b_vocab
-            #(4) note index of max, not max
-            max_vocab = np.argmax( vocab, axis=1 )
-            captions[:,t] = max_vocab
+            #(1) - (3), (4) note index of max, not max
+            if shortlist is None:
+                cur_h, cur_c, vocab = self._decode_step( cur_capts, cur_h, cur_c )
+                max_vocab = np.argmax( vocab, axis=1 )
+            else:
+                cur_h, cur_c = self._recur( cur_capts, cur_h, cur_c )
+                max_vocab = self._shortlist_argmax( cur_capts, cur_h, shortlist,
+                                                    shortlist_threshold, vocab_rows )
+            captions[active, t] = max_vocab
             ##get current word
-            cur_capts = captions[:, t]
+            cur_capts = max_vocab
+
+            # Once a caption emits <END> the rest of it stays <NULL>, so drop its
+            # row from the state and only keep stepping the unfinished ones.
+            unfinished = max_vocab != self._end
+            if not unfinished.all():
+                active = active[unfinished]
+                if len( active ) == 0:
+                    break
+                cur_h, cur_c = cur_h[unfinished], cur_c[unfinished]
+                cur_capts = cur_capts[unfinished]
 
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
         return captions
+
+
+    def sample_random(self, features, max_length=30, num_samples=1, temperature=1.0,
+                      top_k=None, top_p=None, rng=None, state=None):
+        """
+        Run a test-time forward pass for the model, drawing random captions for
+        input feature vectors instead of taking the most likely word.
+
+        At each timestep the scores are divided by the temperature and turned
+        into a softmax distribution. With top_k only the k highest scoring words
+        are kept, and with top_p only the smallest set of most likely words whose
+        total probability reaches top_p; the next word is drawn from what
+        remains. All captions are sampled together, without a loop over rows.
+
+        Inputs:
+        - features: Array of input image features of shape (N, D).
+        - max_length: Maximum length T of generated captions.
+        - num_samples: Number of captions S drawn for each image.
+        - temperature: Positive float; smaller values give more conservative
+          captions and larger values more diverse ones.
+        - top_k: If given, only sample from the top_k highest scoring words.
+        - top_p: If given, a float in (0, 1] for nucleus sampling.
+        - rng: Random number generator with a uniform method, such as a
+          np.random.RandomState, or an integer seed. Defaults to a new
+          unseeded RandomState.
+        - state: Optional decoding state from encode_prefix to continue from.
+
+        Returns:
+        - captions: Array of shape (N * S, max_length); the captions for image i
+          are in rows i * S to (i + 1) * S - 1.
+        """
+        assert temperature > 0, 'temperature must be positive'
+        if rng is None or isinstance( rng, int ):
+            rng = np.random.RandomState( rng )
+
+        cur_h, cur_c, cur_capts = [ np.repeat( a, num_samples, axis=0 )
+                                    for a in self._start_state( features, state ) ]
+        N = cur_h.shape[0]
+        captions = self._null * np.ones((N, max_length), dtype=np.int32)
+        active = np.arange( N )
+
+        for t in range( max_length ):
+            cur_h, cur_c, scores = self._decode_step( cur_capts, cur_h, cur_c )
+            cur_capts = self._sample_words( scores, temperature, top_k, top_p, rng )
+            captions[active, t] = cur_capts
+
+            unfinished = cur_capts != self._end
+            if not unfinished.all():
+                active = active[unfinished]
+                if len( active ) == 0:
+                    break
+                cur_h, cur_c = cur_h[unfinished], cur_c[unfinished]
+                cur_capts = cur_capts[unfinished]
+
+        return captions
+
+
+    def sample_beam(self, features, beam_size=5, max_length=30, length_penalty=1.0,
+                    state=None):
+        """
+        Run a test-time forward pass for the model, decoding captions for input
+        feature vectors with beam search.
+
+        All N images and their beam_size hypotheses are decoded together: every
+        timestep makes one RNN step on an (N * beam_size, H) state matrix and
+        keeps the beam_size best extensions of each image's hypotheses. A
+        hypothesis that emits <END> is finished and keeps its score; decoding
+        stops once every hypothesis is finished or after max_length steps.
+
+        Inputs:
+        - features: Array of input image features of shape (N, D).
+        - beam_size: Number K of hypotheses kept per image.
+        - max_length: Maximum length T of generated captions.
+        - length_penalty: The final hypothesis is picked by its total log
+          probability divided by length ** length_penalty; 0 disables length
+          normalisation.
+        - state: Optional decoding state from encode_prefix to continue from.
+
+        Returns a tuple of:
+        - captions: Array of shape (N, max_length) giving the best caption for
+          each image, in the same format as sample().
+        - scores: Array of shape (N,) giving the length-normalised log
+          probability of each caption.
+        """
+        N, K = features.shape[0], beam_size
+        rows = np.arange(N)[:, None]
+
+        cur_h, cur_c, cur_capts = [ np.repeat( a, K, axis=0 )
+                                    for a in self._start_state( features, state ) ]
+
+        # All beams of an image start out identical, so only the first one may be
+        # extended at the first step.
+        beam_scores = np.zeros((N, K))
+        beam_scores[:, 1:] = -np.inf
+        captions = self._null * np.ones((N, K, max_length), dtype=np.int32)
+        lengths = np.zeros((N, K), dtype=np.int32)
+        finished = np.zeros((N, K), dtype=bool)
+
+        for t in range( 0, max_length ):
+            cur_h, cur_c, vocab = self._decode_step( cur_capts, cur_h, cur_c )
+            V = vocab.shape[1]
+
+            # log-softmax of the scores for every hypothesis
+            vocab = vocab - np.max( vocab, axis=1, keepdims=True )
+            vocab -= np.log( np.sum( np.exp( vocab ), axis=1, keepdims=True ) )
+            log_probs = vocab.reshape( N, K, V )
+
+            # finished hypotheses can only be extended by <NULL>, at no cost
+            log_probs[finished] = -np.inf
+            log_probs[finished, self._null] = 0
+
+            # top K extensions per image over all of its K * V candidates
+            candidates = ( beam_scores[:, :, None] + log_probs ).reshape( N, K * V )
+            best = np.argpartition( -candidates, K - 1, axis=1 )[:, :K]
+            best_scores = candidates[rows, best]
+            order = np.argsort( -best_scores, axis=1 )
+            best, beam_scores = best[rows, order], best_scores[rows, order]
+            source, words = best // V, best % V
+
+            # reorder the state of the surviving hypotheses
+            select = ( rows * K + source ).ravel()
+            cur_h, cur_c = cur_h[select], cur_c[select]
+            captions = captions[rows, source]
+            captions[:, :, t] = words
+            lengths = lengths[rows, source] + ~finished[rows, source]
+            finished = finished[rows, source] | ( words == self._end )
+            cur_capts = words.ravel()
+
+            if finished.all():
+                break
+
+        normalised = beam_scores / np.maximum( lengths, 1 ) ** length_penalty
+        pick = np.argmax( normalised, axis=1 )
+        return captions[np.arange(N), pick], normalised[np.arange(N), pick]
+
+
+    def encode_prefix(self, features, prefix=(), cache=None):
+        """
+        Feed <START> and a caption prefix to the model and return the decoding
+        state, so that several captions can continue the same prefix without
+        recomputing it.
+
+        Inputs:
+        - features: Array of input image features of shape (N, D).
+        - prefix: Integer array of shape (L,), shared by all images, or (N, L)
+          giving the first L words of each caption, without the <START> token.
+        - cache: Optional PrefixCache. States found in the cache are reused and
+          newly computed ones are added to it.
+
+        Returns:
+        - state: Tuple (h, c, words) that can be passed to sample, sample_random
+          or sample_beam. h and c are the hidden and cell states of shape (N, H)
+          and words of shape (N,) holds the last word of the prefix, which has
+          not been fed to the RNN yet.
+        """
+        N = features.shape[0]
+        prefix = np.asarray( prefix, dtype=np.int64 )
+        if prefix.ndim == 1:
+            prefix = np.tile( prefix, ( N, 1 ) )
+
+        keys, missing = None, np.arange( N )
+        if cache is not None:
+            keys = [ cache.key( features[i], prefix[i] ) for i in range( N ) ]
+            states = [ cache.get( k ) for k in keys ]
+            missing = np.array( [ i for i in range( N ) if states[i] is None ], dtype=np.int64 )
+
+        h, c, words = self._start_state( features[missing] )
+        for t in range( prefix.shape[1] ):
+            h, c = self._recur( words, h, c )
+            words = prefix[missing, t]
+        if cache is None:
+            return h, c, words
+
+        for j, i in enumerate( missing ):
+            states[i] = ( h[j].copy(), c[j].copy(), words[j] )
+            cache.put( keys[i], states[i] )
+        return tuple( np.array( [ s[k] for s in states ] ) for k in range( 3 ) )
+
+
+    def quantize(self, mode='int8', block_size=1024):
+        """
+        Make a compact copy of this model for inference. The word embeddings,
+        recurrent weights and vocabulary projection are quantised to int8 with
+        per-channel scales, or stored as float16; see QuantizedMatrix.
+
+        Use cs231n.quantization.caption_agreement to measure how often the
+        quantised model samples the same captions as this one.
+
+        Inputs:
+        - mode: Either 'int8' or 'float16'
+        - block_size: Number of weight columns converted to float32 at a time
+
+        Returns:
+        - model: A QuantizedCaptioningRNN that supports sample and sample_beam
+        """
+        return QuantizedCaptioningRNN(self, mode=mode, block_size=block_size)
+
+
+    def _init_state(self, features):
+        """
+        Compute the initial hidden and cell state for decoding from image
+        features of shape (N, D); the cell state is zero.
+        """
+        W_proj, b_proj = self.params['W_proj'], self.params['b_proj']
+        features = features.astype(self.dtype, copy=False)
+        h = np.dot( features, W_proj ) + b_proj
+        return h, np.zeros_like( h )
+
+
+    def _start_state(self, features, state=None):
+        """
+        Return the decoding state (h, c, words) to start sampling from: the
+        given state, or the initial state for the features and <START>.
+        """
+        if state is not None:
+            return state
+        h, c = self._init_state( features )
+        return h, c, np.full( features.shape[0], self._start )
+
+
+    def _decode_step(self, words, prev_h, prev_c):
+        """
+        Make one test-time step of the RNN.
+
+        Inputs:
+        - words: Integer array of shape (N,) giving the previous words
+        - prev_h, prev_c: Hidden and cell state, of shape (N, H); the cell state
+          is ignored for a vanilla RNN
+
+        Returns a tuple of:
+        - next_h, next_c: The next hidden and cell state
+        - scores: Scores for all vocab words, of shape (N, V)
+        """
+        next_h, next_c = self._recur( words, prev_h, prev_c )
+        return next_h, next_c, self._score( next_h )
+
+
+    def _recur(self, words, prev_h, prev_c):
+        """
+        Embed the previous words and make one RNN step; see _decode_step.
+        """
+        W_embed = self.params['W_embed']
+        Wx, Wh, b = self.params['Wx'], self.params['Wh'], self.params['b']
+
+        #(1) embed previous word
+        x, _ = word_embedding_forward(words, W_embed)
+        #(2) rnn step
+        next_c = prev_c
+        if self.cell_type == 'rnn':
+            next_h, _ = rnn_step_forward( x, prev_h, Wx, Wh, b )
+        #lstm step
+        if self.cell_type == 'lstm':
+            next_h, next_c, _ = lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b)
+        return next_h, next_c
+
+
+    def _score(self, h):
+        """
+        Scores for all vocab words given hidden states of shape (N, H).
+        """
+        #(3) learned affine transformation
+        return np.dot( h, self.params['W_vocab'] ) + self.params['b_vocab']
+
+
+    def _vocab_rows(self):
+        """
+        Return W_vocab.T with contiguous rows, so that the weights of a few
+        words can be gathered quickly.
+        """
+        return np.ascontiguousarray( self.params['W_vocab'].T )
+
+
+    def _shortlist_argmax(self, prev_words, h, shortlist, threshold, vocab_rows):
+        """
+        Pick the next word for each row by scoring only the shortlist of the
+        previous word. Rows where the best candidate has a softmax probability
+        below threshold, taken over the shortlist, are rescored against the
+        full vocabulary. vocab_rows is the output of _vocab_rows.
+        """
+        rows = np.arange( h.shape[0] )
+        candidates = shortlist[prev_words]
+        scores = np.einsum( 'nkh,nh->nk', vocab_rows[candidates], h )
+        scores += self.params['b_vocab'][candidates]
+
+        best = np.argmax( scores, axis=1 )
+        words = candidates[rows, best]
+
+        confidence = 1 / np.sum( np.exp( scores - scores[rows, best][:, None] ), axis=1 )
+        low = confidence < threshold
+        if low.any():
+            words[low] = np.argmax( self._score( h[low] ), axis=1 )
+        return words
+
+
+    def _sample_words(self, scores, temperature, top_k, top_p, rng):
+        """
+        Draw one word per row from the tempered and truncated softmax of scores,
+        of shape (N, V); see sample_random.
+        """
+        N, V = scores.shape
+        rows = np.arange( N )[:, None]
+        logits = scores / temperature
+
+        # Candidate words for each row, as indices into the vocabulary.
+        words = None
+        if top_k is not None and top_k < V:
+            words = np.argpartition( -logits, top_k - 1, axis=1 )[:, :top_k]
+            logits = logits[rows, words]
+        if top_p is not None:
+            order = np.argsort( -logits, axis=1 )
+            words = order if words is None else words[rows, order]
+            logits = logits[rows, order]
+
+        probs = np.exp( logits - np.max( logits, axis=1, keepdims=True ) )
+        cdf = np.cumsum( probs, axis=1 )
+        if top_p is not None:
+            # Keep the words whose preceding mass is still below top_p; the most
+            # likely word is always kept.
+            keep = cdf - probs < top_p * cdf[:, -1:]
+            cdf = np.cumsum( probs * keep, axis=1 )
+
+        # Inverse transform sampling on the (unnormalised) cumulative sums.
+        u = rng.uniform( size=(N, 1) ) * cdf[:, -1:]
+        choice = np.minimum( np.sum( cdf <= u, axis=1 ), cdf.shape[1] - 1 )
+        if words is None:
+            return choice
+        return words[rows[:, 0], choice]
+
+
+class QuantizedCaptioningRNN(CaptioningRNN):
+    """
+    An inference-only CaptioningRNN whose W_embed, Wx, Wh and W_vocab are
+    QuantizedMatrix objects. Build one with CaptioningRNN.quantize().
+    """
+
+    def __init__(self, model, mode='int8', block_size=1024):
+        self.__dict__.update(model.__dict__)
+        self.params = dict(model.params)
+        self.quantization = mode
+        self.params['W_embed'] = QuantizedMatrix(model.params['W_embed'], mode, axis=0,
+                                                 block_size=block_size)
+        for k in ['Wx', 'Wh', 'W_vocab']:
+            self.params[k] = QuantizedMatrix(model.params[k], mode, axis=1,
+                                             block_size=block_size)
+
+
+    def loss(self, features, captions, mode='train', backward=True):
+        raise NotImplementedError('A quantized model can only be used for sampling')
+
+
+    def _recur(self, words, prev_h, prev_c):
+        W_embed = self.params['W_embed']
+        Wx, Wh, b = self.params['Wx'], self.params['Wh'], self.params['b']
+
+        x = W_embed.take(words)
+        act = Wx.project(x)
+        act += Wh.project(prev_h)
+        act += b
+
+        next_c = prev_c
+        if self.cell_type == 'rnn':
+            next_h = np.tanh(act, out=act)
+        if self.cell_type == 'lstm':
+            next_c = np.empty_like(prev_h)
+            squashed = np.empty_like(prev_h)
+            next_h = np.empty_like(prev_h)
+            _lstm_gate_forward(act, prev_c, next_c, squashed, next_h)
+        return next_h, next_c
+
+
+    def _score(self, h):
+        scores = self.params['W_vocab'].project(h)
+        scores += self.params['b_vocab']
+        return scores
+
+
+    def _vocab_rows(self):
+        return self.params['W_vocab'].transpose()
+
+
+class PrefixCache(object):
+    """
+    A least-recently-used cache of decoding states for CaptioningRNN.encode_prefix,
+    keyed by a hash of an image's features and the prefix tokens.
+
+    The states depend on the model parameters, so a cache should only be used
+    with one model and cleared whenever its parameters change.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._states = collections.OrderedDict()
+
+
+    def key(self, features, prefix):
+        """
+        Key for the features of shape (D,) of one image and its prefix tokens.
+        """
+        features = np.ascontiguousarray( features )
+        digest = hashlib.sha1( features.tobytes() ).hexdigest()
+        return features.dtype.str, digest, tuple( int(w) for w in prefix )
+
+
+    def get(self, key):
+        """
+        Return the state stored under key, or None, and mark it recently used.
+        """
+        state = self._states.pop( key, None )
+        if state is None:
+            self.misses += 1
+            return None
+        self._states[key] = state
+        self.hits += 1
+        return state
+
+
+    def put(self, key, state):
+        self._states.pop( key, None )
+        self._states[key] = state
+        while len( self._states ) > self.max_entries:
+            self._states.popitem( last=False )
+
+
+    def clear(self):
+        self._states.clear()
+
+
+    def __len__(self):
+        return len( self._states )
@@ -54,6 +54,73 @@ def load_coco_data(base_dir=BASE_DIR,
     return data
 
 
+def unigram_distribution(captions, vocab_size, null_idx=0, power=0.75):
+    """
+    Build a unigram distribution over the vocabulary from caption token counts,
+    e.g. as the noise distribution for a sampled softmax. Counts are raised to
+    the given power to flatten the distribution, and every word gets at least
+    a count of one so that its probability is nonzero.
+    """
+    counts = np.bincount(captions.ravel(), minlength=vocab_size).astype(np.float64)
+    counts[null_idx] = 0
+    probs = np.maximum(counts, 1) ** power
+    return probs / probs.sum()
+
+
+def build_shortlist(captions, vocab_size, shortlist_size=100, null_idx=0):
+    """
+    Build a per-word shortlist of likely next words from caption bigram counts,
+    for use with CaptioningRNN.sample(shortlist=...).
+
+    Inputs:
+    - captions: Integer array of training captions, of shape (N, T)
+    - vocab_size: Number of words V
+    - shortlist_size: Number K of candidates per word; at most V - 1
+    - null_idx: Index of the <NULL> token, which is never a candidate
+
+    Returns:
+    - shortlist: Integer array of shape (V, K); row w lists the words that
+      most often follow w, followed by the most frequent words overall that
+      are not among them. Each row holds K distinct words, so with K = V - 1
+      every row is the whole vocabulary except <NULL>.
+    """
+    K = min(shortlist_size, vocab_size - 1)
+    prev = captions[:, :-1].ravel()
+    nxt = captions[:, 1:].ravel()
+    keep = nxt != null_idx
+    pairs, counts = np.unique(prev[keep] * vocab_size + nxt[keep], return_counts=True)
+    prev, nxt = pairs // vocab_size, pairs % vocab_size
+
+    # Sort by previous word, then by decreasing count, and keep the first K
+    # entries of each group.
+    order = np.lexsort((-counts, prev))
+    prev, nxt = prev[order], nxt[order]
+    group_start = np.searchsorted(prev, prev)
+    rank = np.arange(len(prev)) - group_start
+    keep = rank < K
+    prev, nxt = prev[keep], nxt[keep]
+
+    unigram = np.bincount(captions.ravel(), minlength=vocab_size)
+    frequent = np.argsort(-unigram, kind='mergesort')
+    frequent = frequent[frequent != null_idx]
+    shortlist = np.tile(frequent[:K], (vocab_size, 1))
+
+    # Pad each row after its successors with the most frequent words that are
+    # not successors; the first K + n frequent words always hold enough.
+    is_succ = np.zeros(vocab_size, dtype=bool)
+    words, starts = np.unique(prev, return_index=True)
+    ends = np.append(starts[1:], len(prev))
+    for w, start, end in zip(words, starts, ends):
+        succ = nxt[start:end]
+        is_succ[succ] = True
+        pad = frequent[:K + len(succ)]
+        pad = pad[~is_succ[pad]]
+        is_succ[succ] = False
+        shortlist[w, :len(succ)] = succ
+        shortlist[w, len(succ):] = pad[:K - len(succ)]
+    return shortlist
+
+
 def decode_captions(captions, idx_to_word):
     singleton = False
     if captions.ndim == 1:
@@ -0,0 +1,263 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+import threading
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from cs231n.coco_utils import sample_coco_minibatch
+
+
+"""
+This file implements minibatch loaders for the CaptioningSolver. A loader has a
+next_batch() method that returns a tuple (captions, features, urls) in the
+same format as sample_coco_minibatch, and a close() method.
+
+MinibatchLoader samples each minibatch when it is asked for one. The
+PrefetchingLoader samples minibatches in a background thread, so that the
+gathers from the (possibly large) feature array overlap with the training
+step that runs on the previous minibatch.
+
+Both loaders take a sampler that picks the captions of each minibatch; the
+default draws them at random with replacement, while an EpochSampler visits
+every caption once per epoch and can put captions of similar length together.
+With trim=True the captions of a minibatch are cut down to its longest caption.
+"""
+
+
+def random_sampler(split_size, batch_size, rng=np.random):
+    """
+    The default minibatch sampler: draw batch_size indices uniformly at random,
+    with replacement, from range(split_size).
+    """
+    return rng.choice(split_size, batch_size)
+
+
+def caption_lengths(captions, null_idx=0):
+    """
+    Return the true length of each caption of shape (N, T), up to and including
+    its last token that is not <NULL>.
+    """
+    not_null = captions != null_idx
+    T = captions.shape[1]
+    return np.where(not_null.any(axis=1), T - np.argmax(not_null[:, ::-1], axis=1), 0)
+
+
+def trim_captions(captions, null_idx=0):
+    """
+    Drop the trailing timesteps that are <NULL> for every caption of shape
+    (N, T). Returns a view of shape (N, T') where T' is the longest true length,
+    but at least 2 so that the caption still has an input and an output.
+    """
+    T = max(np.max(caption_lengths(captions, null_idx)), 2)
+    return captions[:, :T]
+
+
+class EpochSampler(object):
+    """
+    A minibatch sampler that draws captions without replacement: each epoch
+    shuffles all captions once and splits them into minibatches, the last of
+    which may be smaller.
+
+    With bucket_batches set, each window of bucket_batches * batch_size
+    shuffled captions is sorted by caption length before it is split into
+    minibatches, and the minibatches of the epoch are then shuffled. Captions
+    in a minibatch then have similar lengths, so trimming the minibatch to its
+    longest caption removes most of the padding.
+
+    Pass an EpochSampler as the sampler of a MinibatchLoader or
+    PrefetchingLoader; it keeps track of its position in the current epoch.
+    """
+
+    def __init__(self, captions, batch_size=100, bucket_batches=None, null_idx=0):
+        """
+        Inputs:
+        - captions: Integer array of shape (N, T) of the captions to sample from
+        - batch_size: Number of captions per minibatch
+        - bucket_batches: If given, the number of minibatches that are formed
+          from each window of captions sorted by length
+        - null_idx: Index of the <NULL> token
+        """
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.lengths = caption_lengths(captions, null_idx)
+        self.batches_per_epoch = -(-captions.shape[0] // batch_size)
+        self._batches = []
+
+
+    def epoch(self, rng=np.random):
+        """
+        Return the list of minibatch index arrays for a new epoch.
+        """
+        N, B = len(self.lengths), self.batch_size
+        order = rng.permutation(N)
+        if self.bucket_batches:
+            window = B * self.bucket_batches
+            for start in range(0, N, window):
+                chunk = order[start:start + window]
+                order[start:start + window] = chunk[
+                    np.argsort(self.lengths[chunk], kind='mergesort')]
+        batches = [order[start:start + B] for start in range(0, N, B)]
+        if self.bucket_batches:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+
+    def __call__(self, split_size, batch_size, rng=np.random):
+        assert split_size == len(self.lengths) and batch_size == self.batch_size
+        if not self._batches:
+            self._batches = self.epoch(rng)[::-1]
+        return self._batches.pop()
+
+
+class MinibatchLoader(object):
+    """
+    Sample a new minibatch on every call to next_batch, in the calling thread.
+    With the default arguments this is exactly sample_coco_minibatch.
+    """
+
+    def __init__(self, data, batch_size=100, split='train', sampler=None,
+                 trim=False, null_idx=0):
+        self.data = data
+        self.batch_size = batch_size
+        self.split = split
+        self.sampler = sampler
+        self.trim = trim
+        self.null_idx = null_idx
+        self.batches_per_epoch = getattr(sampler, 'batches_per_epoch', None)
+
+
+    def next_batch(self):
+        if self.sampler is None:
+            captions, features, urls = sample_coco_minibatch(
+                self.data, batch_size=self.batch_size, split=self.split)
+        else:
+            split_size = self.data['%s_captions' % self.split].shape[0]
+            mask = self.sampler(split_size, self.batch_size, np.random)
+            captions = self.data['%s_captions' % self.split][mask]
+            image_idxs = self.data['%s_image_idxs' % self.split][mask]
+            features = self.data['%s_features' % self.split][image_idxs]
+            urls = self.data['%s_urls' % self.split][image_idxs]
+        if self.trim:
+            captions = trim_captions(captions, self.null_idx)
+        return captions, features, urls
+
+
+    def close(self):
+        pass
+
+
+class PrefetchingLoader(object):
+    """
+    Prepare the next minibatches in a background thread.
+
+    The loader owns num_prefetch + 1 sets of preallocated minibatch buffers.
+    The worker thread takes a free set, gathers a minibatch into it with
+    np.take (which releases the GIL for the copy) and queues it. The set that
+    next_batch returned last is handed back to the worker on the following
+    call, so a minibatch stays valid until next_batch is called again and at
+    most num_prefetch minibatches are ever waiting.
+
+    Example usage:
+
+    loader = PrefetchingLoader(data, batch_size=100, num_prefetch=2)
+    solver = CaptioningSolver(model, data, loader=loader, ...)
+    solver.train()
+    loader.close()
+    """
+
+    def __init__(self, data, batch_size=100, split='train', num_prefetch=2,
+                 sampler=None, seed=None, trim=False, null_idx=0):
+        """
+        Construct a new PrefetchingLoader and start its worker thread.
+
+        Inputs:
+        - data: A dictionary of data from load_coco_data
+        - batch_size: Number of captions per minibatch
+        - split: Which split of the data to sample from
+        - num_prefetch: Number of minibatches prepared ahead of time
+        - sampler: Function sampler(split_size, batch_size, rng) returning the
+          caption indices of one minibatch; defaults to random_sampler.
+        - seed: Seed for the worker's own RandomState
+        - trim: If True, cut the captions of each minibatch down to its longest
+          caption
+        - null_idx: Index of the <NULL> token, used when trimming
+        """
+        self.batch_size = batch_size
+        self.sampler = sampler or random_sampler
+        self.trim = trim
+        self.null_idx = null_idx
+        self.batches_per_epoch = getattr(sampler, 'batches_per_epoch', None)
+        self._rng = np.random.RandomState(seed)
+
+        self._captions = data['%s_captions' % split]
+        self._image_idxs = data['%s_image_idxs' % split]
+        self._features = data['%s_features' % split]
+        self._urls = data['%s_urls' % split]
+
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        for _ in range(num_prefetch + 1):
+            self._free.put(self._allocate())
+        self._current = None
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def _allocate(self):
+        N = self.batch_size
+        return (np.empty((N,) + self._captions.shape[1:], dtype=self._captions.dtype),
+                np.empty((N,) + self._features.shape[1:], dtype=self._features.dtype),
+                np.empty((N,) + self._urls.shape[1:], dtype=self._urls.dtype),
+                np.empty(N, dtype=self._image_idxs.dtype))
+
+
+    def _run(self):
+        while True:
+            buffers = self._free.get()
+            if buffers is None:
+                return
+            captions, features, urls, image_idxs = buffers
+            try:
+                mask = self.sampler(self._captions.shape[0], self.batch_size, self._rng)
+                n = len(mask)
+                np.take(self._captions, mask, axis=0, out=captions[:n])
+                np.take(self._image_idxs, mask, axis=0, out=image_idxs[:n])
+                np.take(self._features, image_idxs[:n], axis=0, out=features[:n])
+                np.take(self._urls, image_idxs[:n], axis=0, out=urls[:n])
+                batch = (captions[:n], features[:n], urls[:n])
+                if self.trim:
+                    batch = (trim_captions(batch[0], self.null_idx),) + batch[1:]
+            except Exception as e:
+                self._ready.put(e)
+                return
+            self._ready.put((buffers, batch))
+
+
+    def next_batch(self):
+        """
+        Return the next minibatch as a tuple (captions, features, urls). The
+        arrays are reused for a later minibatch once next_batch is called again.
+        """
+        if self._current is not None:
+            self._free.put(self._current)
+            self._current = None
+        item = self._ready.get()
+        if isinstance(item, Exception):
+            raise item
+        self._current, batch = item
+        return batch
+
+
+    def close(self):
+        """
+        Stop the worker thread.
+        """
+        self._free.put(None)
+        self._thread.join()
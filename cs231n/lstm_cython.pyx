@@ -0,0 +1,48 @@
+import numpy as np
+cimport numpy as np
+cimport cython
+
+ctypedef fused DTYPE_t:
+    np.float32_t
+    np.float64_t
+
+
+# There is deliberately no forward kernel: the forward pass is dominated by the
+# sigmoid and tanh evaluations, which NumPy vectorises and a scalar loop over
+# libm cannot match. The backward pass needs no transcendental functions, so a
+# single fused loop beats NumPy's chain of elementwise passes.
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def lstm_gates_backward_cython(DTYPE_t[:, ::1] dnext_h,
+                               DTYPE_t[:, ::1] dnext_c,
+                               DTYPE_t[:, ::1] gates,
+                               DTYPE_t[:, ::1] prev_c,
+                               DTYPE_t[:, ::1] squashed,
+                               DTYPE_t[:, ::1] dact,
+                               DTYPE_t[:, ::1] dprev_c):
+    """
+    Backward pass of the LSTM gate nonlinearities and cell update for one
+    timestep. Writes the gradient of the gate pre-activations into dact (N, 4H)
+    and of the previous cell into dprev_c (N, H). All arrays must be
+    C-contiguous.
+    """
+    cdef Py_ssize_t N = prev_c.shape[0]
+    cdef Py_ssize_t H = prev_c.shape[1]
+    cdef Py_ssize_t n, j
+    cdef DTYPE_t i, f, o, g, s, dh, dc
+
+    for n in range(N):
+        for j in range(H):
+            i = gates[n, j]
+            f = gates[n, H + j]
+            o = gates[n, 2 * H + j]
+            g = gates[n, 3 * H + j]
+            s = squashed[n, j]
+            dh = dnext_h[n, j]
+            dc = dnext_c[n, j] + (1 - s * s) * o * dh
+
+            dact[n, j] = i * (1 - i) * g * dc
+            dact[n, H + j] = f * (1 - f) * prev_c[n, j] * dc
+            dact[n, 2 * H + j] = o * (1 - o) * s * dh
+            dact[n, 3 * H + j] = (1 - g * g) * i * dc
+            dprev_c[n, j] = f * dc
@@ -1,5 +1,7 @@
 import numpy as np
 
+from cs231n.sparse import RowSparseGrad
+
 """
 This file implements various first-order update rules that are commonly used for
 training neural networks. Each update rule accepts current weights and the
@@ -27,6 +29,15 @@ for a variety of different problems.
 
 For efficiency, update rules may perform in-place updates, mutating w and
 setting next_w equal to w.
+
+The update rules below also accept a RowSparseGrad for dw, as produced for
+word embeddings. They then only update the rows of w (and of any moving
+averages in config) that the gradient touches.
+
+adam and rmsprop update w and their moving averages in place, using a scratch
+array kept in config['_scratch'] for intermediate results, so a dense update
+allocates no temporary arrays. This makes it cheap to run one update over all
+parameters of a model stored in a single flat array (see flatten_params).
 """
 
 
@@ -40,6 +51,10 @@ def sgd(w, dw, config=None):
     if config is None: config = {}
     config.setdefault('learning_rate', 1e-2)
 
+    if isinstance(dw, RowSparseGrad):
+        w[dw.idx] -= config['learning_rate'] * dw.rows
+        return w, config
+
     w -= config['learning_rate'] * dw
     return w, config
 
@@ -63,21 +78,49 @@ def adam(x, dx, config=None):
     config.setdefault('beta1', 0.9)
     config.setdefault('beta2', 0.999)
     config.setdefault('epsilon', 1e-8)
-    config.setdefault('m', np.zeros_like(x))
-    config.setdefault('v', np.zeros_like(x))
     config.setdefault('t', 0)
+    # Only allocate the moments on the first call; setdefault would build a
+    # new array every time.
+    if 'm' not in config: config['m'] = np.zeros_like(x)
+    if 'v' not in config: config['v'] = np.zeros_like(x)
 
     next_x = None
     beta1, beta2, eps = config['beta1'], config['beta2'], config['epsilon']
     t, m, v = config['t'], config['m'], config['v']
-    m = beta1 * m + (1 - beta1) * dx
-    v = beta2 * v + (1 - beta2) * (dx * dx)
+
+    if isinstance(dx, RowSparseGrad):
+        # Lazy Adam: the moments of rows without gradient are left untouched.
+        idx, dx = dx.idx, dx.rows
+        m[idx] = beta1 * m[idx] + (1 - beta1) * dx
+        v[idx] = beta2 * v[idx] + (1 - beta2) * (dx * dx)
+        t += 1
+        alpha = config['learning_rate'] * np.sqrt(1 - beta2 ** t) / (1 - beta1 ** t)
+        x[idx] -= alpha * (m[idx] / (np.sqrt(v[idx]) + eps))
+        config['t'] = t
+        return x, config
+
+    if '_scratch' not in config: config['_scratch'] = np.empty_like(x)
+    s = config['_scratch']
     t += 1
     alpha = config['learning_rate'] * np.sqrt(1 - beta2 ** t) / (1 - beta1 ** t)
-    x -= alpha * (m / (np.sqrt(v) + eps))
+
+    # m = beta1 * m + (1 - beta1) * dx
+    np.multiply(dx, 1 - beta1, out=s)
+    m *= beta1
+    m += s
+    # v = beta2 * v + (1 - beta2) * dx ** 2
+    np.multiply(dx, dx, out=s)
+    s *= 1 - beta2
+    v *= beta2
+    v += s
+    # x -= alpha * m / (sqrt(v) + eps)
+    np.sqrt(v, out=s)
+    s += eps
+    np.divide(m, s, out=s)
+    s *= alpha
+    x -= s
+
     config['t'] = t
-    config['m'] = m
-    config['v'] = v
     next_x = x
 
     return next_x, config
@@ -98,7 +141,7 @@ def rmsprop(x, dx, config=None):
   config.setdefault('learning_rate', 1e-2)
   config.setdefault('decay_rate', 0.99)
   config.setdefault('epsilon', 1e-8)
-  config.setdefault('cache', np.zeros_like(x))
+  if 'cache' not in config: config['cache'] = np.zeros_like(x)
 
   next_x = None
   #############################################################################
@@ -107,9 +150,29 @@ def rmsprop(x, dx, config=None):
   # config['cache'].                                                          #
   #############################################################################
 
-  config['cache'] = config['decay_rate'] * config['cache'] + (1 - config['decay_rate']) * dx ** 2
+  if isinstance(dx, RowSparseGrad):
+    idx, dx = dx.idx, dx.rows
+    cache = config['cache']
+    cache[idx] = config['decay_rate'] * cache[idx] + (1 - config['decay_rate']) * dx ** 2
+    x[idx] -= config['learning_rate'] * dx / (np.sqrt(cache[idx]) + config['epsilon'])
+    return x, config
+
+  cache = config['cache']
+  if '_scratch' not in config: config['_scratch'] = np.empty_like(x)
+  s = config['_scratch']
+
+  # cache = decay_rate * cache + (1 - decay_rate) * dx ** 2
+  np.multiply(dx, dx, out=s)
+  s *= 1 - config['decay_rate']
+  cache *= config['decay_rate']
+  cache += s
+  # x -= learning_rate * dx / (sqrt(cache) + epsilon)
+  np.sqrt(cache, out=s)
+  s += config['epsilon']
+  np.divide(dx, s, out=s)
+  s *= config['learning_rate']
   next_x = x
-  next_x -= config['learning_rate'] * dx / (np.sqrt(config['cache']) + config['epsilon'])
+  next_x -= s
 
   #############################################################################
   #                             END OF YOUR CODE                              #
@@ -117,3 +180,29 @@ def rmsprop(x, dx, config=None):
 
   return next_x, config
 
+
+def flatten_params(params):
+    """
+    Move a dictionary of parameter arrays into one contiguous flat array.
+
+    Inputs:
+    - params: Dictionary mapping names to arrays, all of the same dtype
+
+    Returns a tuple of:
+    - flat: 1D array holding all parameters, in sorted order of their names
+    - views: Dictionary mapping each name to a view of flat with the shape of
+      the original array, holding a copy of its values
+    """
+    names = sorted(params)
+    dtypes = set(params[k].dtype for k in names)
+    if len(dtypes) != 1:
+        raise ValueError('Invalid mix of parameter dtypes %s' % sorted(str(d) for d in dtypes))
+
+    flat = np.empty(sum(params[k].size for k in names), dtype=dtypes.pop())
+    views, offset = {}, 0
+    for k in names:
+        size = params[k].size
+        views[k] = flat[offset:offset + size].reshape(params[k].shape)
+        views[k][...] = params[k]
+        offset += size
+    return flat, views
@@ -0,0 +1,302 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+import multiprocessing
+import threading
+import time
+import traceback
+import numpy as np
+
+from cs231n.sparse import RowSparseGrad
+
+
+"""
+This file implements data-parallel training on several processes of one
+machine. A ParallelModel wraps a model such as a CaptioningRNN; its loss method
+splits each minibatch into one shard per worker process, the workers compute
+the gradients of their shards at the same time, and the gradients are summed
+in shared memory. Since it has the same params and loss interface as the
+model, a ParallelModel can be trained with the usual CaptioningSolver:
+
+model = CaptioningRNN(word_to_idx, ...)
+parallel = ParallelModel(model, num_workers=4)
+solver = CaptioningSolver(parallel, data, ...)
+solver.train()
+parallel.close()
+
+The worker processes are forked, so this needs Python 3 on a platform with
+fork. Each worker should use a single BLAS thread; set OMP_NUM_THREADS=1 (or
+the equivalent for your BLAS) before starting Python.
+"""
+
+
+def _shared_array(shape, dtype):
+    """
+    Allocate a zeroed array of the given shape and dtype in shared memory, so
+    that it is visible to forked processes.
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = multiprocessing.RawArray('b', max(size * dtype.itemsize, 1))
+    return np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+
+class SharedParams(dict):
+    """
+    A parameter dictionary whose arrays live in shared memory. Assigning to an
+    existing key copies the new values into the shared array, so updates such
+    as model.params[p] = next_w in the solver are seen by every worker.
+    """
+
+    def __setitem__(self, key, value):
+        if key in self:
+            np.copyto(dict.__getitem__(self, key), value)
+        else:
+            dict.__setitem__(self, key, value)
+
+
+class ParallelModel(object):
+    """
+    Run the loss of a model data-parallel over num_workers processes.
+
+    All parameters are views into one shared buffer. Each worker process writes
+    its shard's gradient, weighted by the shard's share of the minibatch, into
+    its own row of a shared (num_workers, P) buffer. The workers then sum the
+    buffer column-wise, each one over its own slice of the P parameters, into
+    the gradient that loss returns.
+
+    If the loss raises in a worker, the worker sends the traceback back to the
+    calling process and breaks the barriers that the processes synchronise
+    on, so loss raises a RuntimeError instead of waiting forever. The
+    ParallelModel can not be used after that and should be closed.
+
+    Attributes other than params and loss are looked up on the wrapped model,
+    so for example sample still works (in the calling process).
+    """
+
+    def __init__(self, model, num_workers=2, max_batch_size=100, max_length=17,
+                 timeout=600):
+        """
+        Construct a ParallelModel and start its worker processes.
+
+        Inputs:
+        - model: A model object with params and a loss(features, captions)
+          method whose loss and gradients are averages over the minibatch
+        - num_workers: Number of worker processes
+        - max_batch_size: Largest minibatch passed to loss
+        - max_length: Largest caption length passed to loss
+        - timeout: Longest time in seconds that loss waits for the workers; if
+          it is exceeded, for example because a worker was killed, loss raises
+          a RuntimeError
+        """
+        self.model = model
+        self.num_workers = num_workers
+        self.max_batch_size = max_batch_size
+        self.max_length = max_length
+        self.timeout = timeout
+
+        names = sorted(model.params)
+        dtype = model.params[names[0]].dtype
+        sizes = [model.params[k].size for k in names]
+        offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+        total = int(offsets[-1])
+        self._slices = {k: (offsets[i], offsets[i + 1]) for i, k in enumerate(names)}
+        self._shapes = {k: model.params[k].shape for k in names}
+
+        self._param_buf = _shared_array(total, dtype)
+        self._grad_buf = _shared_array((num_workers, total), dtype)
+        self._sum_buf = _shared_array(total, dtype)
+        self._loss_buf = _shared_array(num_workers, np.float64)
+        D = model.params['W_proj'].shape[0]
+        self._features_buf = _shared_array((max_batch_size, D), dtype)
+        self._captions_buf = _shared_array((max_batch_size, max_length), np.int32)
+        self._meta = _shared_array(3, np.int64)  # batch size, length, stop flag
+
+        self.params = SharedParams()
+        for k in names:
+            self.params[k] = self._view(self._param_buf, k)
+            self.params[k][...] = model.params[k]
+        model.params = self.params
+
+        context = multiprocessing.get_context('fork')
+        self._start = context.Barrier(num_workers + 1)
+        self._done = context.Barrier(num_workers + 1)
+        self._written = context.Barrier(num_workers)
+        self._errors = context.SimpleQueue()
+        self._workers = [context.Process(target=self._work, args=(w,))
+                         for w in range(num_workers)]
+        for p in self._workers:
+            p.daemon = True
+            p.start()
+
+
+    def _view(self, buf, name):
+        start, end = self._slices[name]
+        return buf[start:end].reshape(self._shapes[name])
+
+
+    def __getattr__(self, name):
+        if name == 'model':
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+
+    def loss(self, features, captions, mode='train', backward=True):
+        """
+        Compute the loss and gradients of the wrapped model on a minibatch, in
+        the worker processes. Test-mode and forward-only losses are computed in
+        this process.
+
+        Returns a tuple of:
+        - loss: Scalar loss, as the wrapped model would return it
+        - grads: Dictionary of gradients. The arrays are views into a shared
+          buffer and are overwritten by the next call to loss.
+        """
+        if mode != 'train' or not backward:
+            return self.model.loss(features, captions, mode, backward=backward)
+        N, T = captions.shape
+        assert N <= self.max_batch_size and T <= self.max_length
+
+        self._features_buf[:N] = features
+        self._captions_buf[:N, :T] = captions
+        self._meta[:] = N, T, 0
+        try:
+            self._start.wait(self.timeout)
+            self._done.wait(self.timeout)
+        except threading.BrokenBarrierError:
+            self._abort()
+            if not self._errors.empty():
+                raise RuntimeError('ParallelModel worker failed:\n' + self._errors.get())
+            raise RuntimeError('ParallelModel workers failed or timed out')
+
+        grads = {k: self._view(self._sum_buf, k) for k in self._slices}
+        return np.sum(self._loss_buf), grads
+
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        self._meta[2] = 1
+        try:
+            self._start.wait(self.timeout)
+        except threading.BrokenBarrierError:
+            pass
+        for p in self._workers:
+            p.join(self.timeout)
+            if p.is_alive():
+                p.terminate()
+
+
+    def _abort(self):
+        # Breaking every barrier wakes all processes waiting on one of them.
+        for barrier in (self._start, self._written, self._done):
+            barrier.abort()
+
+
+    def _work(self, w):
+        W = self.num_workers
+        total = self._sum_buf.shape[0]
+        reduce_start, reduce_end = w * total // W, (w + 1) * total // W
+
+        try:
+            while self._step(w, reduce_start, reduce_end):
+                pass
+        except threading.BrokenBarrierError:
+            # Another process failed and broke the barriers.
+            pass
+        except Exception:
+            self._errors.put('worker %d: %s' % (w, traceback.format_exc()))
+            self._abort()
+
+
+    def _step(self, w, reduce_start, reduce_end):
+        """
+        Compute the gradient of one shard and sum this worker's slice of the
+        gradients. Returns False once the worker should stop.
+        """
+        self._start.wait()
+        N, T, stop = self._meta
+        if stop:
+            return False
+
+        W = self.num_workers
+        start, end = w * N // W, (w + 1) * N // W
+        grad_row = self._grad_buf[w]
+        if end > start:
+            weight = (end - start) / N
+            loss, grads = self.model.loss(self._features_buf[start:end],
+                                          self._captions_buf[start:end, :T])
+            self._loss_buf[w] = loss * weight
+            for k, dw in grads.items():
+                if isinstance(dw, RowSparseGrad):
+                    dw = dw.todense()
+                np.multiply(dw, weight, out=self._view(grad_row, k))
+        else:
+            self._loss_buf[w] = 0
+            grad_row[...] = 0
+
+        # Once every shard is written, each worker sums its slice.
+        self._written.wait(self.timeout)
+        np.sum(self._grad_buf[:, reduce_start:reduce_end], axis=0,
+               out=self._sum_buf[reduce_start:reduce_end])
+        self._done.wait(self.timeout)
+        return True
+
+
+def benchmark(model, batch_size=256, max_length=17, num_steps=10,
+              worker_counts=(1, 2, 4, 8)):
+    """
+    Time the training loss of a model on random minibatches, in a single
+    process and with ParallelModel for each number of workers. Returns a list
+    of (num_workers, seconds per step), with 0 workers for the plain model.
+    """
+    V = model.params['W_vocab'].shape[1]
+    D = model.params['W_proj'].shape[0]
+    features = np.random.randn(batch_size, D)
+    captions = np.random.randint(1, V, size=(batch_size, max_length))
+
+    def time_loss(m):
+        m.loss(features, captions)
+        start = time.time()
+        for _ in range(num_steps):
+            m.loss(features, captions)
+        return (time.time() - start) / num_steps
+
+    results = [(0, time_loss(model))]
+    for W in worker_counts:
+        parallel = ParallelModel(model, W, batch_size, max_length)
+        try:
+            results.append((W, time_loss(parallel)))
+        finally:
+            parallel.close()
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    from cs231n.classifiers.rnn import CaptioningRNN
+
+    parser = argparse.ArgumentParser(description='Benchmark data-parallel training.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--vocab_size', type=int, default=1004)
+    parser.add_argument('--input_dim', type=int, default=512)
+    parser.add_argument('--hidden_dim', type=int, default=512)
+    parser.add_argument('--cell_type', default='lstm')
+    args = parser.parse_args()
+
+    word_to_idx = {'<NULL>': 0, '<START>': 1, '<END>': 2}
+    for i in range(3, args.vocab_size):
+        word_to_idx['word%d' % i] = i
+    model = CaptioningRNN(word_to_idx, input_dim=args.input_dim,
+                          hidden_dim=args.hidden_dim, cell_type=args.cell_type)
+
+    results = benchmark(model, args.batch_size, num_steps=args.steps,
+                        worker_counts=args.workers)
+    base = results[0][1]
+    print('single process: %.1f ms/step' % (1000 * base))
+    for W, t in results[1:]:
+        print('%d workers: %.1f ms/step, speedup %.2f, efficiency %.2f' % (
+              W, 1000 * t, base / t, base / t / W))
@@ -0,0 +1,193 @@
+from __future__ import print_function, division
+from builtins import object
+import collections
+import csv
+import json
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+"""
+This file implements lightweight profiling of the training loop. A Profiler
+splits the wall time of every iteration into named stages (data, embedding,
+recurrence, vocab_affine, softmax, backward, update, ...): the code calls
+lap(name) at the end of each stage, which costs one clock read. At the end of
+each iteration a record with the stage times, the throughput and optionally the
+peak memory is written to any number of sinks.
+
+Example usage:
+
+profiler = Profiler(sinks=[RingBufferSink(), CSVSink('profile.csv')])
+solver = CaptioningSolver(model, data, profiler=profiler, ...)
+solver.train()
+profiler.close()
+"""
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class StageTimer(object):
+    """
+    Accumulate the time between consecutive calls to lap under the name of
+    the stage that just ended.
+    """
+
+    def __init__(self):
+        self.times = collections.OrderedDict()
+        self._last = _clock()
+
+
+    def start(self):
+        self.times = collections.OrderedDict()
+        self._last = _clock()
+
+
+    def lap(self, name):
+        now = _clock()
+        self.times[name] = self.times.get(name, 0.0) + now - self._last
+        self._last = now
+
+
+class NullTimer(object):
+    """
+    A timer that does nothing, used when profiling is off.
+    """
+
+    def lap(self, name):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Profiler(StageTimer):
+    """
+    A StageTimer that turns every iteration into a record and writes it to a
+    list of sinks. A record holds the iteration number, the seconds spent in
+    every stage, the total, images_per_sec and tokens_per_sec, and with
+    track_memory=True the peak number of bytes allocated during the iteration
+    (from tracemalloc, which slows numpy allocations down a little).
+    """
+
+    def __init__(self, sinks=None, track_memory=False):
+        super(Profiler, self).__init__()
+        self.sinks = sinks if sinks is not None else [RingBufferSink()]
+        self.track_memory = track_memory
+        self.totals = collections.OrderedDict()
+        self.num_iterations = 0
+        self._start = None
+        if track_memory:
+            if tracemalloc is None:
+                raise ImportError('track_memory needs tracemalloc (Python 3.4+)')
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+
+    def start(self):
+        super(Profiler, self).start()
+        self._start = self._last
+        if self.track_memory and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+
+    def end(self, iteration, num_images, num_tokens):
+        """
+        Finish the current iteration and write its record to the sinks.
+        """
+        total = _clock() - self._start
+        record = collections.OrderedDict([('iteration', int(iteration))])
+        for name, seconds in self.times.items():
+            record[name] = seconds
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+        record['total'] = total
+        self.totals['total'] = self.totals.get('total', 0.0) + total
+        record['images_per_sec'] = num_images / total if total > 0 else 0.0
+        record['tokens_per_sec'] = num_tokens / total if total > 0 else 0.0
+        if self.track_memory:
+            record['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        self.num_iterations += 1
+
+        for sink in self.sinks:
+            sink.write(record)
+        return record
+
+
+    def summary(self):
+        """
+        Return a string with the mean time per iteration of every stage and its
+        share of the total.
+        """
+        n = max(self.num_iterations, 1)
+        total = self.totals.get('total', 0.0)
+        lines = []
+        for name, seconds in self.totals.items():
+            share = 100 * seconds / total if total > 0 else 0.0
+            lines.append('%-14s %9.3f ms %6.1f%%' % (name, 1000 * seconds / n, share))
+        return '\n'.join(lines)
+
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class RingBufferSink(object):
+    """
+    Keep the most recent size records in memory, in self.records.
+    """
+
+    def __init__(self, size=1000):
+        self.records = collections.deque(maxlen=size)
+
+
+    def write(self, record):
+        self.records.append(record)
+
+
+    def close(self):
+        pass
+
+
+class CSVSink(object):
+    """
+    Write records as rows of a CSV file; the columns are the fields of the
+    first record.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'w')
+        self._writer = None
+
+
+    def write(self, record):
+        if self._writer is None:
+            self._writer = csv.DictWriter(self._file, fieldnames=list(record),
+                                          restval='', extrasaction='ignore')
+            self._writer.writeheader()
+        self._writer.writerow(record)
+
+
+    def close(self):
+        self._file.close()
+
+
+class JSONLSink(object):
+    """
+    Write each record as one line of JSON.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'w')
+
+
+    def write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+
+
+    def close(self):
+        self._file.close()
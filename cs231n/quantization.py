@@ -0,0 +1,145 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+import numpy as np
+
+
+"""
+This file implements post-training weight quantisation for inference. Weights
+are stored either as int8 with one float32 scale per channel or as float16,
+and are converted back to float32 block by block while they are used, so the
+full-precision matrix never has to be held in memory.
+"""
+
+
+class QuantizedMatrix(object):
+    """
+    A compact read-only copy of a 2D weight matrix W of shape (D, M).
+
+    In 'int8' mode each channel (column for axis=1, row for axis=0) is scaled
+    so that its largest magnitude maps to 127 and is rounded to int8. In
+    'float16' mode the weights are simply stored in half precision. In both
+    cases products are accumulated in float32.
+    """
+
+    def __init__(self, W, mode='int8', axis=1, block_size=1024):
+        """
+        Quantise a weight matrix.
+
+        Inputs:
+        - W: Array of shape (D, M)
+        - mode: Either 'int8' or 'float16'
+        - axis: Axis of W that indexes the channels with their own int8 scale;
+          use 1 for weights that multiply from the right (x.dot(W)) and 0 for
+          embedding matrices whose rows are looked up.
+        - block_size: Number of columns of W that are converted back to float32
+          at a time in project().
+        """
+        if mode not in {'int8', 'float16'}:
+            raise ValueError('Invalid quantization mode "%s"' % mode)
+
+        self.mode = mode
+        self.axis = axis
+        self.block_size = block_size
+        self.shape = W.shape
+        self.scale = None
+
+        if mode == 'float16':
+            self.data = W.astype(np.float16)
+        else:
+            scale = np.max(np.abs(W), axis=1 - axis) / 127.0
+            scale[scale == 0] = 1.0
+            self.scale = scale.astype(np.float32)
+            scaled = W / (self.scale[:, None] if axis == 0 else self.scale)
+            self.data = np.round(scaled).astype(np.int8)
+
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+
+    def dequantize(self):
+        """
+        Return the full float32 matrix; mostly useful for debugging.
+        """
+        W = self.data.astype(np.float32)
+        if self.scale is not None:
+            W *= self.scale[:, None] if self.axis == 0 else self.scale
+        return W
+
+
+    def project(self, x):
+        """
+        Compute x.dot(W) for x of shape (N, D), converting W to float32 one
+        block of columns at a time. Returns an array of shape (N, M).
+        """
+        x = x.astype(np.float32, copy=False)
+        if self.scale is not None and self.axis == 0:
+            x = x * self.scale
+
+        D, M = self.shape
+        out = np.empty((x.shape[0], M), dtype=np.float32)
+        for start in range(0, M, self.block_size):
+            end = min(start + self.block_size, M)
+            out[:, start:end] = x.dot(self.data[:, start:end].astype(np.float32))
+
+        if self.scale is not None and self.axis == 1:
+            out *= self.scale
+        return out
+
+
+    def transpose(self):
+        """
+        Return a QuantizedMatrix for W.T that shares the same int8 scales; a
+        copy of the data is made so that rows of W.T are contiguous.
+        """
+        out = QuantizedMatrix.__new__(QuantizedMatrix)
+        out.mode = self.mode
+        out.axis = 1 - self.axis
+        out.block_size = self.block_size
+        out.shape = self.shape[::-1]
+        out.scale = self.scale
+        out.data = np.ascontiguousarray(self.data.T)
+        return out
+
+
+    def take(self, idx):
+        """
+        Return the float32 rows W[idx].
+        """
+        rows = self.data[idx].astype(np.float32)
+        if self.scale is not None:
+            rows *= self.scale[idx, None] if self.axis == 0 else self.scale
+        return rows
+
+
+    def __getitem__(self, idx):
+        return self.take(idx)
+
+
+def caption_agreement(model, reference, features, max_length=30, batch_size=100):
+    """
+    Compare the captions that two models sample for the same images, e.g. a
+    quantised model against the full-precision model it was made from.
+
+    Inputs:
+    - model, reference: Objects with a sample(features, max_length) method
+    - features: Array of image features of shape (N, D)
+    - max_length: Maximum caption length
+    - batch_size: Number of images sampled at once
+
+    Returns a tuple of:
+    - caption_rate: Fraction of images whose captions are identical
+    - token_rate: Fraction of caption positions with the same word
+    """
+    N = features.shape[0]
+    same_captions, same_tokens = 0, 0
+    for start in range(0, N, batch_size):
+        batch = features[start:start + batch_size]
+        a = model.sample(batch, max_length)
+        b = reference.sample(batch, max_length)
+        same = a == b
+        same_captions += np.sum(np.all(same, axis=1))
+        same_tokens += np.sum(same)
+    return same_captions / N, same_tokens / (N * max_length)
@@ -1,6 +1,13 @@
 from __future__ import print_function, division
 from builtins import range
 import numpy as np
+try:
+    from cs231n.lstm_cython import lstm_gates_backward_cython
+except ImportError:
+    # The Cython gate kernel is optional; fall back to the NumPy version.
+    lstm_gates_backward_cython = None
+
+from cs231n.sparse import RowSparseGrad, sum_rows_by_index
 
 
 """
@@ -87,7 +94,20 @@ def rnn_step_backward(dnext_h, cache):
     return dx, dprev_h, dWx, dWh, db
 
 
-def rnn_forward(x, h0, Wx, Wh, b):
+def _batch_sizes(lengths, N, T):
+    """
+    Number of sequences still active at each of T timesteps, given their
+    lengths sorted in decreasing order; all N when lengths is None.
+    """
+    if lengths is None:
+        return np.full(T, N, dtype=int)
+    lengths = np.asarray(lengths)
+    if np.any(lengths[1:] > lengths[:-1]):
+        raise ValueError('lengths must be sorted in decreasing order')
+    return np.sum(lengths[None, :] > np.arange(T)[:, None], axis=1)
+
+
+def rnn_forward(x, h0, Wx, Wh, b, lengths=None):
     """
     Run a vanilla RNN forward on an entire sequence of data. We assume an input
     sequence composed of T vectors, each of dimension D. The RNN uses a hidden
@@ -100,6 +120,10 @@ def rnn_forward(x, h0, Wx, Wh, b):
     - Wx: Weight matrix for input-to-hidden connections, of shape (D, H)
     - Wh: Weight matrix for hidden-to-hidden connections, of shape (H, H)
     - b: Biases of shape (H,)
+    - lengths: Optional integer array of shape (N,) giving the number of valid
+      timesteps of each sequence, sorted in decreasing order. Timestep t is then
+      only computed for the sequences that are still active, and the hidden
+      states past the end of a sequence are zero.
 
     Returns a tuple of:
     - h: Hidden states for the entire timeseries, of shape (N, T, H).
@@ -112,17 +136,26 @@ def rnn_forward(x, h0, Wx, Wh, b):
     # above. You can use a for loop to help compute the forward pass.            #
     ##############################################################################
     N, T, D, H = x.shape[0], x.shape[1], x.shape[2], b.shape[0]
-    x = x.transpose( 1, 0, 2 )
-    h = np.zeros( shape=(T, N, H))
-    cache = {}
 
+    # Work in (T, N, D) so that each timestep is a contiguous block of rows.
+    x = np.ascontiguousarray(x.transpose( 1, 0, 2 ))
+
+    # The input projection does not depend on the recurrence, so compute it for
+    # all N * T rows with a single GEMM. The result doubles as the hidden state
+    # buffer: step t overwrites its slice of x . Wx + b with h[t].
+    h = np.dot( x.reshape( T * N, D ), Wx ).reshape( T, N, H )
+    h += b
+
+    batch_sizes = _batch_sizes( lengths, N, T )
+    prev_h = h0
     for t in range(0, T):
-        if t == 0:
-            cur_h = h0
-        cur_h, cur_cache = rnn_step_forward( x[t,:,:], cur_h, Wx, Wh, b)
-        cache[ t ] = cur_cache
-        h[t] = cur_h
+        n = batch_sizes[t]
+        h[t, :n] += np.dot( prev_h[:n], Wh )
+        np.tanh( h[t, :n], out=h[t, :n] )
+        h[t, n:] = 0
+        prev_h = h[t]
 
+    cache = x, h0, h, Wx, Wh, batch_sizes
     h = h.transpose( 1, 0, 2 )
     ##############################################################################
     #                               END OF YOUR CODE                             #
@@ -150,30 +183,36 @@ def rnn_backward(dh, cache):
     # sequence of data. You should use the rnn_step_backward function that you   #
     # defined above. You can use a for loop to help compute the backward pass.   #
     ##############################################################################
-    dim_x = cache[0][2]
-    N, T, H, D = dh.shape[0], dh.shape[1], dh.shape[2], dim_x.shape[1]
-
-    dx = np.zeros( shape=( T, N, D ) )
-    dWx = np.zeros( shape=(D, H))
-    dWh = np.zeros( shape=(H, H) )
-    db = np.zeros( shape=( H, ))
+    x, h0, h, Wx, Wh, batch_sizes = cache
+    N, T, H, D = dh.shape[0], dh.shape[1], dh.shape[2], x.shape[2]
     dh = dh.transpose( 1, 0, 2 )
 
+    # Only the gradient flowing back through Wh is sequential. Collect the
+    # gradient of the tanh pre-activation for every timestep in one buffer and
+    # compute the weight and input gradients from it after the loop.
+    dtanh = np.empty( shape=(T, N, H), dtype=h.dtype )
+    dprev_h = np.zeros( shape=(N, H), dtype=h.dtype )
     for t in range(T-1, -1, -1 ):
-        if t == ( T - 1 ):
-            dprev_h = np.zeros( shape=(dh[t].shape ))
-        cur_cache = cache[t]
-        cur_dx, dprev_h, cur_dWx, cur_dWh, cur_db = rnn_step_backward( dh[t] + dprev_h, cur_cache )
-        dx[t] = cur_dx
-        dWx += cur_dWx
-        dWh += cur_dWh
-        db += cur_db
-        if t == 0:
-            dh0 = dprev_h
+        n = batch_sizes[t]
+        np.multiply( 1 - ( h[t, :n] * h[t, :n] ), dh[t, :n] + dprev_h[:n], out=dtanh[t, :n] )
+        dtanh[t, n:] = 0
+        if n == N:
+            dprev_h = np.dot( dtanh[t], Wh.T )
+        else:
+            dprev_h = np.zeros_like( dprev_h )
+            dprev_h[:n] = np.dot( dtanh[t, :n], Wh.T )
+    dh0 = dprev_h
+
+    dtanh_flat = dtanh.reshape( T * N, H )
+    dx = np.dot( dtanh_flat, Wx.T ).reshape( T, N, D )
+    dWx = np.dot( x.reshape( T * N, D ).T, dtanh_flat )
+    dWh = np.dot( h0.T, dtanh[0] )
+    if T > 1:
+        dWh += np.dot( h[:-1].reshape( (T - 1) * N, H ).T, dtanh_flat[N:] )
+    db = np.sum( dtanh_flat, axis=0 )
 
     dx = dx.transpose( 1, 0, 2 )
 
-
     ##############################################################################
     #                               END OF YOUR CODE                             #
     ##############################################################################
@@ -209,7 +248,7 @@ def word_embedding_forward(x, W):
     return out, cache
 
 
-def word_embedding_backward(dout, cache):
+def word_embedding_backward(dout, cache, sparse=False):
     """
     Backward pass for word embeddings. We cannot back-propagate into the words
     since they are integers, so we only return gradient for the word embedding
@@ -220,6 +259,8 @@ def word_embedding_backward(dout, cache):
     Inputs:
     - dout: Upstream gradients of shape (N, T, D)
     - cache: Values from the forward pass
+    - sparse: If True, return the gradient as a RowSparseGrad holding only the
+      rows of the words that appear in x.
 
     Returns:
     - dW: Gradient of word embedding matrix, of shape (V, D).
@@ -233,12 +274,16 @@ def word_embedding_backward(dout, cache):
     ##############################################################################
     x, W = cache
     N, T, D = dout.shape
-    dW = np.zeros( shape=( W.shape ))
 
     flat_x = x.reshape( N * T )
     flat_dout = dout.reshape( N*T, D)
 
-    np.add.at( dW, flat_x, flat_dout[ np.arange( N *T ) ])
+    # Sum the rows of repeated words first, so that each row of dW is written
+    # exactly once instead of scattering with np.add.at.
+    idx, rows = sum_rows_by_index( flat_x, flat_dout )
+    dW = RowSparseGrad( idx, rows.astype( W.dtype, copy=False ), W.shape )
+    if not sparse:
+        dW = dW.todense()
 
     ##############################################################################
     #                               END OF YOUR CODE                             #
@@ -246,18 +291,57 @@ def word_embedding_backward(dout, cache):
     return dW
 
 
-def sigmoid(x):
+def sigmoid(x, out=None):
     """
     A numerically stable version of the logistic sigmoid function.
+
+    This is evaluated in a single pass as 0.5 * (1 + tanh(x / 2)), which never
+    overflows and needs no temporaries. Pass out=x to compute it in place.
     """
-    pos_mask = (x >= 0)
-    neg_mask = (x < 0)
-    z = np.zeros_like(x)
-    z[pos_mask] = np.exp(-x[pos_mask])
-    z[neg_mask] = np.exp(x[neg_mask])
-    top = np.ones_like(x)
-    top[neg_mask] = z[neg_mask]
-    return top / (1 + z)
+    out = np.multiply(x, 0.5, out=out)
+    np.tanh(out, out=out)
+    out += 1
+    out *= 0.5
+    return out
+
+
+def _use_lstm_cython(*arrays):
+    """
+    Check whether the Cython gate backward kernel is built and can take these
+    arrays.
+    """
+    if lstm_gates_backward_cython is None:
+        return False
+    dtype = arrays[0].dtype
+    if dtype != np.float32 and dtype != np.float64:
+        return False
+    return all(a.dtype == dtype and a.flags.c_contiguous for a in arrays)
+
+
+def _lstm_gate_forward(act, prev_c, next_c, squashed, next_h):
+    """
+    Gate nonlinearities and cell update for a single LSTM timestep.
+
+    The pre-activations in act are overwritten with the gate activations, and
+    the new cell state, its tanh and the new hidden state are written into the
+    preallocated output buffers.
+
+    Inputs:
+    - act: Gate pre-activations of shape (N, 4H), in i, f, o, g order
+    - prev_c: Previous cell state, of shape (N, H)
+    - next_c, squashed, next_h: Output arrays of shape (N, H)
+    """
+    H = prev_c.shape[1]
+
+    # i, f and o are contiguous in each row, so one sigmoid call covers them
+    sigmoid( act[:,0:3*H], out=act[:,0:3*H] )
+    np.tanh( act[:,3*H:4*H], out=act[:,3*H:4*H] )
+    i, f, o, g = act[:,0:H], act[:,H:2*H], act[:,2*H:3*H], act[:,3*H:4*H]
+
+    np.multiply( f, prev_c, out=next_c )
+    next_c += i * g
+    np.tanh( next_c, out=squashed )
+    np.multiply( o, squashed, out=next_h )
 
 
 def lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b):
@@ -290,23 +374,17 @@ def lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b):
     N, D, H = prev_h.shape[0], Wx.shape[0], prev_h.shape[1]
 
     #compute activation matrix, dimensions are (N, 4H)
-    act_vec = np.dot( x, Wx ) + np.dot( prev_h, Wh ) + b
+    act_vec = np.dot( x, Wx )
+    act_vec += np.dot( prev_h, Wh )
+    act_vec += b
 
-    ##slice into activation matrix to get activation vectors
-    ai, af, ao, ag = act_vec[:,0:H], act_vec[:,H:2*H], act_vec[:,2*H:3*H], act_vec[:,3*H:4*H]
+    ##compute gates in place, then the next cell and hidden state
+    next_c = np.empty_like( act_vec[:,0:H] )
+    squashed = np.empty_like( next_c )
+    next_h = np.empty_like( next_c )
+    _lstm_gate_forward( act_vec, prev_c, next_c, squashed, next_h )
 
-    ##compute gates
-
-    i = sigmoid( ai )
-    f = sigmoid( af )
-    o = sigmoid( ao )
-    g = np.tanh( ag )
-
-    next_c = f * prev_c + i * g
-    squashed = np.tanh( next_c )
-    next_h = o * squashed
-
-    cache = i, f, o, g, prev_c, prev_h, x, squashed, Wh, Wx
+    cache = act_vec, prev_c, prev_h, x, squashed, Wh, Wx
 
     ##############################################################################
     #                               END OF YOUR CODE                             #
@@ -315,6 +393,60 @@ def lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b):
     return next_h, next_c, cache
 
 
+def _lstm_gate_backward(dnext_h, dnext_c, gates, prev_c, squashed, dact):
+    """
+    Backward pass of _lstm_gate_forward for a single LSTM timestep.
+
+    Inputs:
+    - dnext_h, dnext_c: Gradients of next hidden and cell state, of shape (N, H)
+    - gates: Gate activations from the forward pass, of shape (N, 4H)
+    - prev_c: Previous cell state, of shape (N, H)
+    - squashed: tanh of the next cell state, of shape (N, H)
+    - dact: Array of shape (N, 4H) that receives the gradient of the gate
+      pre-activations, in i, f, o, g order.
+
+    Returns:
+    - dprev_c: Gradient of previous cell state, of shape (N, H)
+    """
+    dprev_c = np.empty_like( prev_c )
+    if _use_lstm_cython(dnext_h, dnext_c, gates, prev_c, squashed, dact):
+        lstm_gates_backward_cython(dnext_h, dnext_c, gates, prev_c, squashed,
+                                   dact, dprev_c)
+        return dprev_c
+
+    H = dnext_h.shape[1]
+    i, f, o, g = gates[:,0:H], gates[:,H:2*H], gates[:,2*H:3*H], gates[:,3*H:4*H]
+    di, df = dact[:,0:H], dact[:,H:2*H]
+    do, dg = dact[:,2*H:3*H], dact[:,3*H:4*H]
+
+    # local derivatives of the nonlinearities, from their outputs
+    np.multiply( i, i - 1, out=di )
+    np.multiply( f, f - 1, out=df )
+    np.multiply( o, o - 1, out=do )
+    np.multiply( g, g, out=dg )
+    dact *= -1
+    dg += 1
+
+    # gradient of the next cell state, including the path through next_h
+    np.multiply( squashed, squashed, out=dprev_c )
+    np.subtract( 1, dprev_c, out=dprev_c )
+    dprev_c *= o
+    dprev_c *= dnext_h
+    dprev_c += dnext_c
+
+    di *= g
+    di *= dprev_c
+    df *= prev_c
+    df *= dprev_c
+    do *= squashed
+    do *= dnext_h
+    dg *= i
+    dg *= dprev_c
+    dprev_c *= f
+
+    return dprev_c
+
+
 def lstm_step_backward(dnext_h, dnext_c, cache):
     """
     Backward pass for a single timestep of an LSTM.
@@ -339,32 +471,12 @@ def lstm_step_backward(dnext_h, dnext_c, cache):
     # HINT: For sigmoid and tanh you can compute local derivatives in terms of  #
     # the output value from the nonlinearity.                                   #
     #############################################################################
-    i, f, o, g, prev_c, prev_h, x, squashed, Wh, Wx = cache
+    gates, prev_c, prev_h, x, squashed, Wh, Wx = cache
     N, H, D = dnext_h.shape[0], dnext_h.shape[1], x.shape[1]
 
-    dsquashed = o * dnext_h
-    dadd_c = (1 - (squashed * squashed))* dsquashed
-    dnext_c += dadd_c
-
-    dg_next = i * dnext_c
-    df_next = dnext_c * prev_c
-    di_next = g * dnext_c
-    do_next = squashed * dnext_h
-    dprev_c = f * dnext_c
-
-    ##backprop through non-linearities
-    dg = ( 1 - (g*g)) * dg_next
-    df = f*(1-f) * df_next
-    di = i * (1 - i) * di_next
-    do = o * (1 - o) * do_next
-
-    ##put them back into the activation matrix
-    dact_vec = np.zeros( shape=( N, 4*H) )
-
-    dact_vec[:,0:H] = di
-    dact_vec[:,H:2*H] = df
-    dact_vec[:,2*H:3*H] = do
-    dact_vec[:,3*H:4*H] = dg
+    ##backprop through the gates into the activation matrix
+    dact_vec = np.empty_like( gates )
+    dprev_c = _lstm_gate_backward( dnext_h, dnext_c, gates, prev_c, squashed, dact_vec )
 
     db = np.sum( dact_vec, axis=0)
     dWx = np.dot( x.T, dact_vec)
@@ -379,7 +491,71 @@ def lstm_step_backward(dnext_h, dnext_c, cache):
     return dx, dprev_h, dprev_c, dWx, dWh, db
 
 
-def lstm_forward(x, h0, Wx, Wh, b):
+def _lstm_segment_forward(x, prev_h, prev_c, Wx, Wh, b, h, batch_sizes):
+    """
+    Run the LSTM forward over a segment of L consecutive timesteps.
+
+    Inputs:
+    - x: Input data for the segment, of shape (L, N, D)
+    - prev_h, prev_c: Hidden and cell state entering the segment, of shape (N, H)
+    - Wx, Wh, b: LSTM parameters
+    - h: Array of shape (L, N, H) that receives the hidden states
+    - batch_sizes: Number of active sequences at each timestep, of shape (L,)
+
+    Returns a tuple of:
+    - gates: Gate activations, of shape (L, N, 4H)
+    - c: Cell states, of shape (L, N, H)
+    - squashed: tanh of the cell states, of shape (L, N, H)
+    """
+    L, N, D = x.shape
+    H = prev_h.shape[1]
+
+    # Input projection for every timestep in one GEMM; each step then only adds
+    # prev_h . Wh and overwrites its slice with the gate activations.
+    gates = np.dot( x.reshape( L * N, D ), Wx ).reshape( L, N, 4 * H )
+    gates += b
+    c = np.empty( shape=( L, N, H ), dtype=gates.dtype )
+    squashed = np.empty( shape=( L, N, H ), dtype=gates.dtype )
+
+    for t in range( 0, L ):
+        n = batch_sizes[t]
+        gates[t, :n] += np.dot( prev_h[:n], Wh )
+        _lstm_gate_forward( gates[t, :n], prev_c[:n], c[t, :n], squashed[t, :n], h[t, :n] )
+        c[t, n:] = 0
+        h[t, n:] = 0
+        prev_h, prev_c = h[t], c[t]
+
+    return gates, c, squashed
+
+
+def _lstm_segment_backward(dh, dnext_h, dnext_c, gates, c, squashed, prev_c, Wh, dact,
+                           batch_sizes):
+    """
+    Run the recurrent part of the LSTM backward pass over a segment of L
+    timesteps, writing the gate pre-activation gradients into dact (L, N, 4H).
+
+    Returns the gradients of the hidden and cell state entering the segment.
+    """
+    L, N = gates.shape[0], gates.shape[1]
+    for t in range(L - 1, -1, -1):
+        n = batch_sizes[t]
+        cur_prev_c = c[t - 1] if t > 0 else prev_c
+        if n == N:
+            dnext_c = _lstm_gate_backward( dh[t] + dnext_h, dnext_c, gates[t], cur_prev_c, squashed[t], dact[t] )
+            dnext_h = np.dot( dact[t], Wh.T )
+        else:
+            # Finished sequences neither use nor pass back any gradient.
+            dact[t, n:] = 0
+            dprev_c = np.zeros_like( dnext_c )
+            dprev_c[:n] = _lstm_gate_backward( dh[t, :n] + dnext_h[:n], dnext_c[:n], gates[t, :n],
+                                               cur_prev_c[:n], squashed[t, :n], dact[t, :n] )
+            dnext_c = dprev_c
+            dnext_h = np.zeros_like( dnext_h )
+            dnext_h[:n] = np.dot( dact[t, :n], Wh.T )
+    return dnext_h, dnext_c
+
+
+def lstm_forward(x, h0, Wx, Wh, b, c0=None, checkpoint_every=None, lengths=None):
     """
     Forward pass for an LSTM over an entire sequence of data. We assume an input
     sequence composed of T vectors, each of dimension D. The LSTM uses a hidden
@@ -389,6 +565,8 @@ def lstm_forward(x, h0, Wx, Wh, b):
     Note that the initial cell state is passed as input, but the initial cell
     state is set to zero. Also note that the cell state is not returned; it is
     an internal variable to the LSTM and is not accessed from outside.
+    (Callers that continue a sequence across calls can pass the previous cell
+    state as c0 and read the last one back with lstm_final_cell.)
 
     Inputs:
     - x: Input data of shape (N, T, D)
@@ -396,6 +574,18 @@ def lstm_forward(x, h0, Wx, Wh, b):
     - Wx: Weights for input-to-hidden connections, of shape (D, 4H)
     - Wh: Weights for hidden-to-hidden connections, of shape (H, 4H)
     - b: Biases of shape (4H,)
+    - c0: Optional initial cell state of shape (N, H); zero if not given.
+      No gradient is returned for it.
+    - checkpoint_every: If given, only keep the cell state every this many
+      timesteps and recompute the gate activations, cell states and tanh of
+      the cell states of each segment during the backward pass, at the cost of
+      a second forward pass. The cache still holds the input x of shape
+      (T, N, D) and all hidden states of shape (T, N, H); what is dropped are
+      the per-step buffers of shape (T, N, 4H) and two of shape (T, N, H),
+      which are replaced by one (N, H) cell state per segment plus the buffers
+      of the one segment being recomputed (k timesteps).
+    - lengths: Optional integer array of shape (N,) giving the number of valid
+      timesteps of each sequence, sorted in decreasing order; see rnn_forward.
 
     Returns a tuple of:
     - h: Hidden states for all timesteps of all sequences, of shape (N, T, H)
@@ -409,17 +599,28 @@ def lstm_forward(x, h0, Wx, Wh, b):
     N, T, D, H = x.shape[0], x.shape[1], x.shape[2], h0.shape[1]
 
     #into dims (T, N, D)
-    x = x.transpose( 1, 0, 2 )
-    h = np.zeros( shape=(T, N, H ))
-    cache = {}
-
-    for t in range( 0, T ):
-        if t == 0:
-            cur_h = h0
-            cur_c = np.zeros( shape=(cur_h.shape))
-        cur_h, cur_c, cache[t] = lstm_step_forward(x[t], cur_h, cur_c, Wx, Wh, b)
-        h[t] = cur_h
-
+    x = np.ascontiguousarray(x.transpose( 1, 0, 2 ))
+    h = np.empty( shape=( T, N, H ), dtype=np.result_type( x, Wx, b ) )
+    if c0 is None:
+        c0 = np.zeros( shape=( N, H ), dtype=h.dtype )
+
+    # Without checkpointing the whole sequence is a single segment whose gate
+    # and cell buffers are kept for the backward pass. With checkpointing only
+    # the cell state entering each segment is kept.
+    k = checkpoint_every or T
+    batch_sizes = _batch_sizes( lengths, N, T )
+    segment_c0, saved = [], []
+    prev_h, prev_c = h0, c0
+    for start in range( 0, T, k ):
+        end = min( start + k, T )
+        gates, c, squashed = _lstm_segment_forward( x[start:end], prev_h, prev_c, Wx, Wh, b, h[start:end],
+                                                    batch_sizes[start:end] )
+        segment_c0.append( prev_c )
+        if checkpoint_every is None:
+            saved.append( ( gates, c, squashed ) )
+        prev_h, prev_c = h[end - 1], c[-1].copy()
+
+    cache = x, h0, segment_c0, saved, h, prev_c, Wx, Wh, b, k, batch_sizes
     h = h.transpose( 1, 0, 2 )
     ##############################################################################
     #                               END OF YOUR CODE                             #
@@ -449,28 +650,48 @@ def lstm_backward(dh, cache):
     # You should use the lstm_step_backward function that you just defined.     #
     #############################################################################
 
-    dim_x = cache[0][6]
-    N, T, H, D = dh.shape[0], dh.shape[1], dh.shape[2], dim_x.shape[1]
-
-    dx = np.zeros( shape=(T, N, D))
-    dh0 = np.zeros( shape=(N, H))
-    dWx = np.zeros( shape=(D, 4*H))
-    dWh = np.zeros( shape=(H, 4*H))
-    db = np.zeros( shape=(4*H,))
+    x, h0, segment_c0, saved, h, c_last, Wx, Wh, b, k, batch_sizes = cache
+    N, T, H, D = dh.shape[0], dh.shape[1], dh.shape[2], x.shape[2]
     dh = dh.transpose( 1, 0, 2)
 
-    for t in range(T - 1, -1, -1):
-        if t == (T - 1):
-            dprev_h = np.zeros(shape=(dh[t].shape))
-            dprev_c = np.zeros( shape=(dh[t].shape))
-        cur_cache = cache[t]
-        cur_dx, dprev_h, dprev_c, cur_dWx, cur_dWh, cur_db = lstm_step_backward(dh[t] + dprev_h, dprev_c, cur_cache)
-        dx[t] = cur_dx
-        dWx += cur_dWx
-        dWh += cur_dWh
-        db += cur_db
-        if t == 0:
-            dh0 = dprev_h
+    dx = np.empty( shape=(T, N, D), dtype=h.dtype )
+    dWx = np.zeros( shape=(D, 4*H), dtype=h.dtype )
+    dWh = np.zeros( shape=(H, 4*H), dtype=h.dtype )
+    db = np.zeros( shape=(4*H,), dtype=h.dtype )
+    dprev_h = np.zeros( shape=(N, H), dtype=h.dtype )
+    dprev_c = np.zeros( shape=(N, H), dtype=h.dtype )
+
+    # Only dprev_h and dprev_c are carried through time. Within a segment the
+    # gradients of the gate pre-activations for all timesteps go into one
+    # buffer, from which the weight and input gradients are computed with a few
+    # large GEMMs once the segment is done.
+    starts = list( range( 0, T, k ) )
+    for s in range( len( starts ) - 1, -1, -1 ):
+        start, end = starts[s], min( starts[s] + k, T )
+        L = end - start
+        prev_h = h[start - 1] if start > 0 else h0
+
+        if saved:
+            gates, c, squashed = saved[s]
+        else:
+            # Recompute this segment from its checkpoint; the hidden states it
+            # produces are identical to the ones already stored in h.
+            gates, c, squashed = _lstm_segment_forward( x[start:end], prev_h, segment_c0[s], Wx, Wh, b,
+                                                        np.empty( shape=( L, N, H ), dtype=h.dtype ),
+                                                        batch_sizes[start:end] )
+
+        dact = np.empty_like( gates )
+        dprev_h, dprev_c = _lstm_segment_backward( dh[start:end], dprev_h, dprev_c, gates, c, squashed,
+                                                   segment_c0[s], Wh, dact, batch_sizes[start:end] )
+
+        dact_flat = dact.reshape( L * N, 4*H )
+        dx[start:end] = np.dot( dact_flat, Wx.T ).reshape( L, N, D )
+        dWx += np.dot( x[start:end].reshape( L * N, D ).T, dact_flat )
+        dWh += np.dot( prev_h.T, dact[0] )
+        if L > 1:
+            dWh += np.dot( h[start:end - 1].reshape( (L - 1) * N, H ).T, dact_flat[N:] )
+        db += np.sum( dact_flat, axis=0 )
+    dh0 = dprev_h
 
     dx = dx.transpose(1, 0, 2)
 
@@ -482,26 +703,44 @@ def lstm_backward(dh, cache):
     return dx, dh0, dWx, dWh, db
 
 
-def temporal_affine_forward(x, w, b):
+def lstm_final_cell(cache):
+    """
+    Return the cell state after the last timestep of an lstm_forward call, of
+    shape (N, H), given the cache from that call.
+    """
+    c_last = cache[5]
+    return c_last
+
+
+def temporal_affine_forward(x, w, b, mask=None):
     """
     Forward pass for a temporal affine layer. The input is a set of D-dimensional
     vectors arranged into a minibatch of N timeseries, each of length T. We use
     an affine function to transform each of those vectors into a new vector of
     dimension M.
 
+    If a mask is given, only the P vectors x[mask] are transformed and the
+    output is packed: row p of out corresponds to the p-th True entry of mask
+    in row-major order. temporal_softmax_loss accepts this packed layout.
+
     Inputs:
     - x: Input data of shape (N, T, D)
     - w: Weights of shape (D, M)
     - b: Biases of shape (M,)
+    - mask: Optional boolean array of shape (N, T)
 
     Returns a tuple of:
-    - out: Output data of shape (N, T, M)
+    - out: Output data of shape (N, T, M), or (P, M) if mask is given
     - cache: Values needed for the backward pass
     """
     N, T, D = x.shape
     M = b.shape[0]
-    out = x.reshape(N * T, D).dot(w).reshape(N, T, M) + b
-    cache = x, w, b, out
+    if mask is None:
+        out = x.reshape(N * T, D).dot(w).reshape(N, T, M) + b
+    else:
+        x = x[mask]
+        out = x.dot(w) + b
+    cache = x, w, b, mask, (N, T, D)
     return out, cache
 
 
@@ -510,7 +749,8 @@ def temporal_affine_backward(dout, cache):
     Backward pass for temporal affine layer.
 
     Input:
-    - dout: Upstream gradients of shape (N, T, M)
+    - dout: Upstream gradients of shape (N, T, M), or (P, M) if the forward pass
+      was given a mask
     - cache: Values from forward pass
 
     Returns a tuple of:
@@ -518,10 +758,16 @@ def temporal_affine_backward(dout, cache):
     - dw: Gradient of weights, of shape (D, M)
     - db: Gradient of biases, of shape (M,)
     """
-    x, w, b, out = cache
-    N, T, D = x.shape
+    x, w, b, mask, (N, T, D) = cache
     M = b.shape[0]
 
+    if mask is not None:
+        dx = np.zeros((N, T, D), dtype=dout.dtype)
+        dx[mask] = dout.dot(w.T)
+        dw = x.T.dot(dout)
+        db = dout.sum(axis=0)
+        return dx, dw, db
+
     dx = dout.reshape(N * T, M).dot(w.T).reshape(N, T, D)
     dw = dout.reshape(N * T, M).T.dot(x.reshape(N * T, D)).T
     db = dout.sum(axis=(0, 1))
@@ -545,7 +791,9 @@ def temporal_softmax_loss(x, y, mask, verbose=False):
     which elements should contribute to the loss.
 
     Inputs:
-    - x: Input scores, of shape (N, T, V)
+    - x: Input scores, of shape (N, T, V), or packed scores of shape (P, V)
+      holding only the P timesteps where mask is True, as produced by
+      temporal_affine_forward with a mask.
     - y: Ground-truth indices, of shape (N, T) where each element is in the range
          0 <= y[i, t] < V
     - mask: Boolean array of shape (N, T) where mask[i, t] tells whether or not
@@ -553,29 +801,182 @@ def temporal_softmax_loss(x, y, mask, verbose=False):
 
     Returns a tuple of:
     - loss: Scalar giving loss
-    - dx: Gradient of loss with respect to scores x.
+    - dx: Gradient of loss with respect to scores x, of the same shape as x.
     """
 
-    N, T, V = x.shape
-
-    x_flat = x.reshape(N * T, V)
-    y_flat = y.reshape(N * T)
-    mask_flat = mask.reshape(N * T)
+    if x.ndim == 2:
+        # Packed scores: every row contributes, so no masking is needed.
+        N, P = y.shape[0], x.shape[0]
+        x_flat, y_flat = x, y[mask]
+        mask_flat = np.ones(P, dtype=bool)
+    else:
+        N, T, V = x.shape
+        P = N * T
+        x_flat = x.reshape(P, V)
+        y_flat = y.reshape(P)
+        mask_flat = mask.reshape(P)
 
     probs = np.exp(x_flat - np.max(x_flat, axis=1, keepdims=True))
     probs /= np.sum(probs, axis=1, keepdims=True)
-    loss = -np.sum(mask_flat * np.log(probs[np.arange(N * T), y_flat])) / N
-    dx_flat = probs.copy()
-    dx_flat[np.arange(N * T), y_flat] -= 1
+    loss = -np.sum(mask_flat * np.log(probs[np.arange(P), y_flat])) / N
+    dx_flat = probs
+    dx_flat[np.arange(P), y_flat] -= 1
     dx_flat /= N
     dx_flat *= mask_flat[:, None]
 
     if verbose: print('dx_flat: ', dx_flat.shape)
 
-    dx = dx_flat.reshape(N, T, V)
+    dx = dx_flat.reshape(x.shape)
 
     return loss, dx
 
+def temporal_affine_softmax_loss(x, w, b, y, mask, block_size=256, backward=True):
+    """
+    Fused temporal affine layer and temporal softmax loss, with the backward
+    pass of both. This computes the same loss and gradients as
+    temporal_affine_forward, temporal_softmax_loss and temporal_affine_backward
+    in sequence, but works through the P timesteps where mask is True in blocks
+    of block_size rows. Only one (block_size, M) block of scores exists at any
+    time instead of the full (N, T, M) scores, probabilities and gradient.
+
+    Inputs:
+    - x: Input data of shape (N, T, D)
+    - w: Weights of shape (D, M)
+    - b: Biases of shape (M,)
+    - y: Ground-truth indices, of shape (N, T) where each element is in the range
+         0 <= y[i, t] < M
+    - mask: Boolean array of shape (N, T) of the timesteps that contribute to
+      the loss
+    - block_size: Number of timesteps to score at once
+    - backward: If False, only compute the loss and return it on its own
+
+    Returns a tuple of:
+    - loss: Scalar giving loss
+    - dx: Gradient with respect to x, of shape (N, T, D)
+    - dw: Gradient with respect to w, of shape (D, M)
+    - db: Gradient with respect to b, of shape (M,)
+    """
+    N, T, D = x.shape
+    x_packed, y_packed = x[mask], y[mask]
+    P = x_packed.shape[0]
+
+    if not backward:
+        loss = 0.0
+        for start in range(0, P, block_size):
+            end = min(start + block_size, P)
+            scores = x_packed[start:end].dot(w)
+            scores += b
+            scores -= np.max(scores, axis=1, keepdims=True)
+            correct = scores[np.arange(end - start), y_packed[start:end]]
+            np.exp(scores, out=scores)
+            loss += np.sum(np.log(np.sum(scores, axis=1)) - correct)
+        return loss / N
+
+    loss = 0.0
+    dx_packed = np.empty_like(x_packed)
+    dw = np.zeros(w.shape, dtype=np.result_type(x, w))
+    db = np.zeros(b.shape, dtype=dw.dtype)
+
+    for start in range(0, P, block_size):
+        end = min(start + block_size, P)
+        rows = np.arange(end - start)
+        x_block, y_block = x_packed[start:end], y_packed[start:end]
+
+        # Softmax in place on the block of scores, with the log-sum-exp taken
+        # from the shifted scores so that the loss never takes log(0).
+        probs = x_block.dot(w)
+        probs += b
+        probs -= np.max(probs, axis=1, keepdims=True)
+        correct = probs[rows, y_block]
+        np.exp(probs, out=probs)
+        sums = np.sum(probs, axis=1)
+        loss += np.sum(np.log(sums) - correct)
+        probs /= sums[:, None]
+
+        probs[rows, y_block] -= 1
+        probs /= N
+        dx_packed[start:end] = probs.dot(w.T)
+        dw += x_block.T.dot(probs)
+        db += np.sum(probs, axis=0)
+
+    dx = np.zeros((N, T, D), dtype=dx_packed.dtype)
+    dx[mask] = dx_packed
+
+    return loss / N, dx, dw, db
+
+def temporal_sampled_softmax_loss(x, w, b, y, mask, num_sampled, noise):
+    """
+    Sampled softmax approximation to the temporal affine layer followed by the
+    temporal softmax loss, for training with a large vocabulary.
+
+    Instead of scoring all M words, we draw num_sampled candidate words (with
+    replacement) from a noise distribution and compute a softmax over the true
+    word and the candidates only. Candidate scores are corrected by the log of
+    their expected count, and candidates that happen to be the true word are
+    removed. This only approximates the full softmax, so it should be used for
+    training and not for evaluating the loss.
+
+    Inputs:
+    - x: Input data of shape (N, T, D)
+    - w: Weights of shape (D, M)
+    - b: Biases of shape (M,)
+    - y: Ground-truth indices, of shape (N, T) where each element is in the range
+         0 <= y[i, t] < M
+    - mask: Boolean array of shape (N, T) of the timesteps that contribute to
+      the loss
+    - num_sampled: Number S of candidate words to draw
+    - noise: Array of shape (M,) giving the noise distribution; it should be
+      nonzero for every word
+
+    Returns a tuple of:
+    - loss: Scalar giving the sampled loss
+    - dx: Gradient with respect to x, of shape (N, T, D)
+    - dw: Gradient with respect to w, of shape (D, M)
+    - db: Gradient with respect to b, of shape (M,)
+    """
+    N, T, D = x.shape
+    M = b.shape[0]
+    x_packed, y_packed = x[mask], y[mask]
+    P = x_packed.shape[0]
+
+    sampled = np.random.choice(M, size=num_sampled, p=noise)
+    w_sampled = w[:, sampled]
+    w_true = w[:, y_packed].T
+
+    # Column 0 holds the true word, the remaining S columns the candidates.
+    logits = np.empty((P, num_sampled + 1), dtype=np.result_type(x, w))
+    logits[:, 0] = np.sum(x_packed * w_true, axis=1) + b[y_packed]
+    logits[:, 0] -= np.log(num_sampled * noise[y_packed])
+    logits[:, 1:] = x_packed.dot(w_sampled) + b[sampled]
+    logits[:, 1:] -= np.log(num_sampled * noise[sampled])
+    logits[:, 1:][sampled[None, :] == y_packed[:, None]] = -np.inf
+
+    logits -= np.max(logits, axis=1, keepdims=True)
+    probs = np.exp(logits)
+    sums = np.sum(probs, axis=1)
+    loss = np.sum(np.log(sums) - logits[:, 0]) / N
+
+    dlogits = probs / sums[:, None]
+    dlogits[:, 0] -= 1
+    dlogits /= N
+    dtrue, dsampled = dlogits[:, 0], dlogits[:, 1:]
+
+    dx_packed = dtrue[:, None] * w_true + dsampled.dot(w_sampled.T)
+    dx = np.zeros((N, T, D), dtype=dx_packed.dtype)
+    dx[mask] = dx_packed
+
+    # Words can repeat among both the targets and the candidates.
+    idx, rows = sum_rows_by_index(np.concatenate((y_packed, sampled)),
+                                  np.concatenate((dtrue[:, None] * x_packed,
+                                                  dsampled.T.dot(x_packed))))
+    dw = np.zeros((M, D), dtype=dx_packed.dtype)
+    dw[idx] = rows
+    dw = dw.T
+    db = np.bincount(y_packed, weights=dtrue, minlength=M)
+    db += np.bincount(sampled, weights=np.sum(dsampled, axis=0), minlength=M)
+
+    return loss, dx, dw, db.astype(dw.dtype)
+
 if __name__ == "__main__":
     from cs231n.gradient_check import eval_numerical_gradient, eval_numerical_gradient_array
 
@@ -583,3 +984,111 @@ if __name__ == "__main__":
         """ returns relative error """
         return np.max(np.abs(x - y) / (np.maximum(1e-8, np.abs(x) + np.abs(y))))
 
+
+    # Sampled softmax. With the random candidates fixed by a seed the sampled
+    # loss is an ordinary function, so its gradients can be checked.
+    print('Testing temporal_sampled_softmax_loss')
+    np.random.seed(231)
+    N, T, D, M, S = 3, 4, 5, 8, 6
+    x = np.random.randn(N, T, D)
+    w = np.random.randn(D, M)
+    b = np.random.randn(M)
+    y = np.random.randint(M, size=(N, T))
+    mask = np.random.rand(N, T) > 0.3
+    noise = np.random.rand(M)
+    noise /= noise.sum()
+
+    def seeded_loss(x, w, b):
+        np.random.seed(0)
+        return temporal_sampled_softmax_loss(x, w, b, y, mask, S, noise)
+
+    loss, dx, dw, db = seeded_loss(x, w, b)
+    dx_num = eval_numerical_gradient(lambda x: seeded_loss(x, w, b)[0], x, verbose=False)
+    dw_num = eval_numerical_gradient(lambda w: seeded_loss(x, w, b)[0], w, verbose=False)
+    db_num = eval_numerical_gradient(lambda b: seeded_loss(x, w, b)[0], b, verbose=False)
+    print('dx error: ', rel_error(dx, dx_num))
+    print('dw error: ', rel_error(dw, dw_num))
+    print('db error: ', rel_error(db, db_num))
+
+    # Candidates equal to the target word are dropped from its softmax, so the
+    # loss of each target is a softmax over itself and the other candidates.
+    np.random.seed(0)
+    sampled = np.random.choice(M, size=S, p=noise)
+    expected = 0
+    for xi, yi in zip(x[mask], y[mask]):
+        keep = sampled[sampled != yi]
+        logits = np.concatenate(([xi.dot(w[:, yi]) + b[yi] - np.log(S * noise[yi])],
+                                 xi.dot(w[:, keep]) + b[keep] - np.log(S * noise[keep])))
+        expected += np.log(np.sum(np.exp(logits - logits[0])))
+    print('accidental hits error: ', rel_error(loss, expected / N))
+
+    # If every candidate is an accidental hit, nothing is left to compete with
+    # the targets and the loss and gradients vanish.
+    noise_hit = np.full(M, 1e-12)
+    noise_hit[3] = 1 - (M - 1) * 1e-12
+    loss, dx, dw, db = temporal_sampled_softmax_loss(x, w, b, np.full((N, T), 3), mask, S, noise_hit)
+    print('all hits loss: ', loss, ' max gradient: ', max(np.max(np.abs(d)) for d in (dx, dw, db)))
+
+    # Convergence: train a tiny LSTM captioning model with the full and with the
+    # sampled softmax and compare the exact loss they end at. The captions come
+    # from a Markov chain and the image features are constant, so the models
+    # cannot memorise the captions and both approach the same lowest loss. The
+    # sampled softmax is a biased estimate whose gap shrinks as num_sampled
+    # grows; with twice as many samples as words it ends within a few percent.
+    print('Testing CaptioningRNN convergence with sampled softmax')
+    from cs231n.classifiers.rnn import CaptioningRNN
+    from cs231n.coco_utils import unigram_distribution
+    from cs231n.optim import adam
+
+    N, T, V, D = 100, 8, 20, 10
+    rng = np.random.RandomState(0)
+    word_to_idx = {'<NULL>': 0, '<START>': 1, '<END>': 2}
+    for i in range(3, V):
+        word_to_idx['word%d' % i] = i
+    successors = rng.randint(3, V, size=(V, 2))
+    captions = np.ones((N, T), dtype=int)
+    captions[:, 1] = rng.randint(3, V, size=N)
+    for t in range(2, T):
+        captions[:, t] = successors[captions[:, t - 1], rng.randint(2, size=N)]
+    features = np.zeros((N, D))
+
+    def train_captioning(sampled_softmax, num_iterations=600):
+        np.random.seed(0)
+        model = CaptioningRNN(word_to_idx, input_dim=D, wordvec_dim=16, hidden_dim=32,
+                              cell_type='lstm', dtype=np.float64,
+                              sampled_softmax=sampled_softmax)
+        configs = {p: {'learning_rate': 3e-2} for p in model.params}
+        for _ in range(num_iterations):
+            _, grads = model.loss(features, captions)
+            for p in model.params:
+                model.params[p], configs[p] = adam(model.params[p], grads[p], configs[p])
+                configs[p]['learning_rate'] *= 0.995
+        return model.loss(features, captions, mode='test')[0]
+
+    full_loss = train_captioning(None)
+    sampled_loss = train_captioning({'num_sampled': 2 * V,
+                                     'noise': unigram_distribution(captions, V)})
+    print('initial loss: ', (T - 1) * np.log(V))
+    print('full softmax loss: ', full_loss)
+    print('sampled softmax loss: ', sampled_loss)
+    print('relative difference: ', abs(sampled_loss - full_loss) / full_loss)
+
+    # Shortlists: every row of build_shortlist holds distinct words, and with
+    # the whole vocabulary as shortlist, sampling matches greedy sampling.
+    print('Testing build_shortlist')
+    from cs231n.coco_utils import build_shortlist
+
+    captions = np.array([[1, 3, 4, 2, 0], [1, 3, 4, 2, 0], [1, 4, 5, 2, 0], [1, 5, 2, 0, 0]])
+    shortlist = build_shortlist(captions, 6, 3)
+    print('rows of distinct words: ', all(len(set(row)) == 3 for row in shortlist))
+    print('successors of <START> first: ', shortlist[1])
+
+    np.random.seed(231)
+    model = CaptioningRNN(word_to_idx, input_dim=D, wordvec_dim=16, hidden_dim=32,
+                          cell_type='lstm', dtype=np.float64)
+    model.params['b_vocab'][0] = -1e3  # shortlists never hold <NULL>
+    shortlist = build_shortlist(captions, V, V - 1)
+    features = np.random.randn(20, D)
+    greedy = model.sample(features, 10)
+    shortlisted = model.sample(features, 10, shortlist=shortlist, shortlist_threshold=0)
+    print('full shortlist matches greedy: ', np.all(greedy == shortlisted))
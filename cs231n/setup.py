@@ -7,6 +7,9 @@ extensions = [
   Extension('im2col_cython', ['im2col_cython.pyx'],
             include_dirs = [numpy.get_include()]
   ),
+  Extension('lstm_cython', ['lstm_cython.pyx'],
+            include_dirs = [numpy.get_include()]
+  ),
 ]
 
 setup(
@@ -0,0 +1,65 @@
+from __future__ import print_function, division
+from builtins import object
+import numpy as np
+
+
+"""
+This file implements a row-sparse gradient type for weight matrices of which a
+minibatch only touches a few rows, such as word embeddings. It is shared by
+the layers that produce such gradients and the update rules and solvers that
+consume them.
+"""
+
+
+def sum_rows_by_index(idx, rows):
+    """
+    Sum the rows that share an index. This is a sort-based equivalent of
+    np.add.at(out, idx, rows) that only produces the touched rows.
+
+    Inputs:
+    - idx: Integer array of shape (K,)
+    - rows: Array of shape (K, D)
+
+    Returns a tuple of:
+    - unique_idx: Sorted unique values of idx, of shape (U,)
+    - summed: Array of shape (U, D) where summed[j] is the sum of the rows with
+      index unique_idx[j]
+    """
+    order = np.argsort( idx, kind='mergesort' )
+    sorted_idx = idx[order]
+    if len( sorted_idx ) == 0:
+        return sorted_idx, rows[order]
+    starts = np.flatnonzero( np.concatenate( ( [True], sorted_idx[1:] != sorted_idx[:-1] ) ) )
+    return sorted_idx[starts], np.add.reduceat( rows[order], starts, axis=0 )
+
+
+class RowSparseGrad(object):
+    """
+    Gradient of a weight matrix that is nonzero only in a few rows, such as the
+    gradient of a word embedding matrix. The update rules in optim.py accept
+    it in place of a dense gradient and only update the touched rows.
+
+    Attributes:
+    - idx: Sorted unique row indices, of shape (K,)
+    - rows: Gradient rows for those indices, of shape (K, D)
+    - shape: Shape of the dense gradient
+    """
+
+    def __init__(self, idx, rows, shape):
+        self.idx = idx
+        self.rows = rows
+        self.shape = shape
+
+    @property
+    def dtype(self):
+        return self.rows.dtype
+
+    def todense(self):
+        dense = np.zeros( self.shape, dtype=self.rows.dtype )
+        dense[self.idx] = self.rows
+        return dense
+
+    def __add__(self, other):
+        idx, rows = sum_rows_by_index( np.concatenate( ( self.idx, other.idx ) ),
+                                       np.concatenate( ( self.rows, other.rows ) ) )
+        return RowSparseGrad( idx, rows, self.shape )